@@ -1,41 +1,68 @@
 import modules.default_parameters as dp
 import os
+import signal
 import numpy as np
-from multiprocessing import Process, Queue, Event
-from queue import Full, Empty
+import pyaudio
+import multiprocessing as mp
+from multiprocessing import Process
+from threading import Thread, Event
 from modules.setup import SetupHandler
-from modules.audioprocessing import LFAudioInputHandler, HFAudioInputHandler
-from modules.audio_producer import AudioProducer
+from modules.audioprocessing import LFAudioInputHandlerBatch, HFAudioInputHandler
+from modules.audio_producer import AudioProducer, LiveAudioProducer
+from modules.ipc import SharedAudioRing, SharedChannelSettings
+from modules.connection import OSCConnectionHandler
+from modules.kernels import downmix
 import modules.utilities as ut
 import modules.custom_exceptions as ce
 
 
-def stop_execution(lf_queue: Queue, hf_queue: Queue, streams: list):
-    """Stops all concurrent worker processes. It does so by putting a number of `None` objects inside the
-    multiprocessing `Queues`.
+def stop_execution(rings: list, streams: list):
+    """Stops all concurrent worker processes. It does so by closing the shared audio rings, so that each worker
+    receives `None` once it has read all the remaining chunks.
 
     **Args:**
 
-    `lf_queue`: Common queue for all Low Level Features workers.
-
-    `hf_queue`: Common queue for all High Level Features workers.
+    `rings`: Rings of all Low Level Features and High Level Features workers.
 
     `streams`: All currently open streams of audio.
     """
-    for _ in range(dp.CPU_PARAMETERS['numLfCores']):
-        lf_queue.put(None)  # When the worker reads `None` from the queue it breaks its loop
-    for _ in range(dp.CPU_PARAMETERS['numHfCores']):
-        hf_queue.put(None)
-    for s in streams:
+    for s in streams:  # Streams are stopped first, so that stream callbacks don't write into closed rings
         if s:
             s.stop_stream()
             s.close()
+    for ring in rings:  # When the worker reads `None` from the ring it breaks its loop
+        ring.close()
+    ut.flush_logs()
+
+
+def close_worker():
+    """Lets a worker process end cleanly, after every feature it computed has been sent and every log printed.
+    """
+    net_parameters = dp.NET_PARAMETERS
+    OSCConnectionHandler.get_instance(net_parameters['outNetAddress'], net_parameters['outNetPort']).close()
+    ut.flush_logs()
+
+
+def init_worker(core):
+    """Prepares a worker process before it starts its loop. Workers ignore keyboard interrupts, so that stopping the
+    application is left to the main process, which sets a single event and lets the producer close the rings.
+
+    **Args:**
+
+    `core`: CPU core to pin the process to (`None` to leave it unpinned).
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ut.pin_to_core(core)
 
 
-def audio_producer(audio_producer_object: AudioProducer, control_event, lf_queue: Queue, hf_queue: Queue, parameters: dict):
-    """Produces audio for the worker processes. Each chunk of audio read from the audio source is sent to the low-level
-    feature processes to extract low-level features. Audio chunks are summed to a total length of n seconds before
-    being sent to the high-level feature processes.
+def audio_producer(audio_producer_object: AudioProducer, control_event, lf_rings: list, lf_channel_ranges: list,
+                   hf_ring: SharedAudioRing, parameters: dict, core):
+    """Produces audio for the worker processes. Each chunk of audio read from the audio source is split by channel
+    between the low-level feature processes to extract low-level features. Audio chunks are summed to a total length
+    of n seconds before being sent to the high-level feature processes. With a single LF worker, both are written once,
+    straight into the slots of the shared rings.
+    Live audio is captured in callback mode, so chunks are published directly from PortAudio's thread. Runs on a thread
+    of the main process, as producing audio only waits on I/O.
 
     **Args:**
 
@@ -43,46 +70,113 @@ def audio_producer(audio_producer_object: AudioProducer, control_event, lf_queue
 
     `control_event`: Event used to check if the program's execution has to be stopped.
 
-    `lf_queue`: Common queue for LLF workers used to send the chunks of audio to process.
+    `lf_rings`: Shared memory ring of each LLF worker used to send the chunks of audio to process.
+
+    `lf_channel_ranges`: Range of the channels written in each of the `lf_rings`.
 
-    `hf_queue`: Common queue for HLF workers used to send the chunks of audio to process.
+    `hf_ring`: Common shared memory ring for HLF workers used to send the chunks of audio to process.
 
     `parameters`: Dictionary containing audio processing parameters used to produce audio.
+
+    `core`: CPU core to pin the thread to (`None` to leave it unpinned).
     """
+    ut.pin_to_core(core)
+    ut.set_realtime_priority(dp.CPU_PARAMETERS['producerRealtimePriority'])  # Before streams start their own threads
     sh = SetupHandler.get_instance()
-    sh.set_audio_parameters(parameters)
-    in_stream, out_stream = sh.get_audio_streams()
-    data_type = parameters['npFormat']
+    data_type = parameters['transportFormat']
+    chunk_size = parameters['chunkSize']
     hf_number_of_samples = parameters['hfNumberOfSamples']
-    hf_data = np.array([], dtype=data_type)
+    mono_chunk = ut.aligned_empty(chunk_size, data_type)
+    full_chunk = ut.aligned_empty((parameters['channels'], chunk_size), data_type)
+    lf_reserve = lf_rings[0].reserve  # Bound methods and functions used on every chunk are cached as locals
+    lf_commit = lf_rings[0].commit
+    lf_slots = [(ring.reserve, ring.commit, channels.start, channels.stop)
+                for ring, channels in zip(lf_rings, lf_channel_ranges)]
+    hf_reserve = hf_ring.reserve
+    hf_commit = hf_ring.commit
+    hf_data = hf_reserve()  # The HF window is downmixed in place, chunk after chunk
+    hf_position = 0
+
+    def publish_chunk(fill_chunk, *args):
+        """Writes the next chunk of audio into the LF ring and downmixes it into the HF window, publishing the window
+        once it's full.
+
+        **Args:**
+
+        `fill_chunk`: Function that writes the chunk into the array given as its last argument.
+
+        `args`: Arguments given to `fill_chunk` before the array.
+        """
+        nonlocal hf_data, hf_position
+        if len(lf_slots) == 1:  # The only LF worker takes every channel, so the chunk is written straight into its ring
+            audio_chunk = lf_reserve()
+            fill_chunk(*args, audio_chunk)
+            lf_commit()
+        else:  # Each LF worker gets a copy of its own channels
+            audio_chunk = full_chunk
+            fill_chunk(*args, audio_chunk)
+            for reserve, commit, start, stop in lf_slots:
+                np.copyto(reserve(), audio_chunk[start:stop])
+                commit()
+
+        if hf_position + chunk_size <= hf_number_of_samples:  # Downmixes straight into the HF window
+            downmix(audio_chunk, hf_data[hf_position:hf_position+chunk_size])
+            hf_position += chunk_size
+        else:  # The chunk straddles two windows, so it's downmixed into a scratch buffer and split
+            downmix(audio_chunk, mono_chunk)
+            taken = hf_number_of_samples - hf_position
+            hf_data[hf_position:] = mono_chunk[:taken]
+            hf_commit()
+            hf_data = hf_reserve()
+            hf_position = chunk_size - taken  # Leftover samples start the next window
+            hf_data[:hf_position] = mono_chunk[taken:]
+
+        if hf_position == hf_number_of_samples:
+            hf_commit()
+            hf_data = hf_reserve()
+            hf_position = 0
+
+    if isinstance(audio_producer_object, LiveAudioProducer):
+        write_chunk = audio_producer_object.write_chunk
+
+        def stream_callback(in_data, frame_count, time_info, status):
+            """Called by PortAudio from its own thread every time a chunk of audio has been captured.
+
+            **Returns:**
+
+            A `tuple` telling PortAudio to keep the stream going (input streams don't return any audio).
+            """
+            try:
+                publish_chunk(write_chunk, in_data)
+            except Exception as e:
+                ut.print_error("Something bad happened while producing audio")
+                ut.print_dbg(e)
+            return None, pyaudio.paContinue
+
+        in_stream, out_stream = sh.get_audio_streams(stream_callback)
+        ut.print_success("Started audio producer thread")
+        while in_stream.is_active() and not control_event.wait(timeout=0.5):
+            pass
+        stop_execution([*lf_rings, hf_ring], [in_stream, out_stream])
+        return
 
-    ut.print_success("Started audio producer process")
+    in_stream, out_stream = sh.get_audio_streams()
+    is_stopped = control_event.is_set
+    get_next_chunk = audio_producer_object.get_next_chunk
+
+    ut.print_success("Started audio producer thread")
 
     while True:
         try:
-            if control_event.is_set():
-                stop_execution(lf_queue, hf_queue, [in_stream, out_stream])
+            if is_stopped():
+                stop_execution([*lf_rings, hf_ring], [in_stream, out_stream])
                 return
 
-            audio_chunk = audio_producer_object.get_next_chunk(in_stream, out_stream)
-            audio_chunk_np = np.array(audio_chunk, dtype=data_type, copy=True)
-
-            lf_queue.put_nowait(audio_chunk)
-            audio_chunk_np = audio_chunk_np.sum(axis=0)/float(len(audio_chunk))
-            hf_data = np.concatenate((hf_data, audio_chunk_np), dtype=data_type)
-
-            if len(hf_data) >= hf_number_of_samples:
-                cut_data = hf_data[hf_number_of_samples:len(hf_data)]
-                hf_data = hf_data[0:hf_number_of_samples]
-                hf_queue.put(np.copy(hf_data))
-                hf_data = np.array(cut_data, dtype=data_type)
+            publish_chunk(get_next_chunk, in_stream, out_stream)
 
-        except Full:
-            ut.print_warning("Queue is full")
-            continue
         except ce.FinishedSongException as e:
             ut.print_info("Song is finished")
-            stop_execution(lf_queue, hf_queue, [in_stream, out_stream])
+            stop_execution([*lf_rings, hf_ring], [in_stream, out_stream])
             return
         except ce.AudioProducingException as e:
             ut.print_error(e)
@@ -91,107 +185,162 @@ def audio_producer(audio_producer_object: AudioProducer, control_event, lf_queue
             ut.print_dbg(e)
 
 
-def lf_audio_consumer(lf_queue: Queue, settings_queue: Queue, parameters: dict):
-    """Processes low-level features from audio chunks given from the `audio_producer` process.
+def lf_audio_consumer(lf_ring: SharedAudioRing, channel_settings: SharedChannelSettings, channels: range,
+                      parameters: dict, core):
+    """Processes low-level features from audio chunks given from the `audio_producer` thread. Each worker owns a
+    range of channels, so the features of a channel are always computed (and sent) in order.
 
     **Args:**
 
-    `lf_queue`: Queue where audio chunks to process are sent by the audio_producer process.
+    `lf_ring`: Shared memory ring where audio chunks to process are written by the `audio_producer` thread.
 
-    `settings_queue`: Queue where audio settings (coming from osc messages) are sent - used to change settings
-    of the LLF handlers.
+    `channel_settings`: Settings of each channel (coming from osc messages) - used to change settings of the LLF
+    handlers.
+
+    `channels`: Range of the channels processed by this worker.
 
     `parameters`: Dictionary containing audio processing parameters used to produce audio.
+
+    `core`: CPU core to pin the process to (`None` to leave it unpinned).
     """
-    lf_audio_input_handlers = []
-    channels = parameters['channels']
-    instruments = parameters['instruments']
-    for i in range(channels):
-        lf_audio_input_handlers.append(LFAudioInputHandler(parameters, i, instruments[i]))
-    
+    init_worker(core)
+    instruments = parameters['instruments'][channels.start:channels.stop]
+    lf_audio_input_handler = LFAudioInputHandlerBatch(parameters, instruments, channels)
+    settings_version = 0
+    batch_size = dp.BUFFER_PARAMETERS['lfBatchSize']
+
     ut.print_success("Started LF consumer process")
     while True:
-        data = lf_queue.get()
-        if data is None:
+        batch = lf_ring.get_batch(batch_size)  # Takes every chunk already available, up to batch_size
+        if batch is None:
             ut.print_info("Shutting down LF process...")
             break
 
-        try:
-            channel, settings = settings_queue.get_nowait()
-            for handler in lf_audio_input_handlers:
-                if handler.channel == channel:
-                    handler.handle_settings(settings)
-                    break
-        except Empty:
-            pass
+        if channel_settings.get_version() != settings_version:  # Settings are read only when they change
+            settings_version = channel_settings.get_version()
+            lf_audio_input_handler.set_instruments(channel_settings.get_instruments()[channels.start:channels.stop])
 
         try:
-            for i in range(len(lf_audio_input_handlers)):
-                lf_audio_input_handlers[i].process(data[i])
+            lf_audio_input_handler.process_batch(batch)
         except Exception as e:
             ut.print_error("Something bad happened while processing audio (LLF)")
             ut.print_dbg(e)
+        lf_ring.release()  # Slots go back to the producer now, instead of being held while waiting for the next batch
 
+    close_worker()
 
-def hf_audio_consumer(hf_queue: Queue, parameters: dict):
-    """Processes high-level features from audio chunks given from the `audio_producer` process.
+
+def hf_audio_consumer(hf_ring: SharedAudioRing, parameters: dict, core):
+    """Processes high-level features from audio chunks given from the `audio_producer` thread.
 
     **Args:**
 
-    `hf_queue`: Queue where audio chunks to process are sent by the `audio_producer` process.
+    `hf_ring`: Shared memory ring where audio chunks to process are written by the `audio_producer` thread.
 
     `parameters`: Dictionary containing audio processing parameters used to produce audio.
+
+    `core`: CPU core to pin the process to (`None` to leave it unpinned).
     """
+    init_worker(core)
     hf_audio_input_handler = HFAudioInputHandler(parameters, 0, ut.Instruments.DEFAULT)
+    batch_size = dp.BUFFER_PARAMETERS['hfBatchSize']
 
     ut.print_success("Started HF consumer process")
     while True:
-        data = hf_queue.get()
-        if data is None:
+        batch = hf_ring.get_batch(batch_size)  # Windows that piled up during an inference are predicted together
+        if batch is None:
             ut.print_info("Shutting down HF process...")
             break
         try:
-            hf_audio_input_handler.process(data)
+            hf_audio_input_handler.process_batch(batch)
         except Exception as e:
             ut.print_error("Something bad happened while processing audio (HLF)")
             ut.print_dbg(e)
+        hf_ring.release()
+
+    close_worker()
 
 
 if __name__ == "__main__":
+    # Workers are forked from a server process that has already imported this script (and with it librosa and
+    # tensorflow), instead of re-importing everything in each of them. Windows only supports spawn.
+    mp.set_start_method('forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn')
+
     sh = SetupHandler.get_instance()  # General setup of the application is handled by the SetupHandler singleton
     sh.set_main_path(os.path.dirname(__file__))
     parameters = sh.setup()
     audio_producer_object = sh.get_audio_producer()
+    # Already held by the producer, avoids sending songs to every worker
+    parameters = {key: value for key, value in parameters.items() if key != 'tracks'}
 
-    control_event = Event()  # Initializes multiprocessing objects
+    control_event = Event()  # Initializes synchronization objects (the producer runs in this process)
     cpu_parameters = dp.CPU_PARAMETERS
-    lf_queue = Queue()
-    hf_queue = Queue()
-    settings_queue = Queue()
+    buffer_parameters = dp.BUFFER_PARAMETERS
+    # Channels are split between LF workers
+    number_of_lf_workers = min(cpu_parameters['numLfCores'], parameters['channels'])
+    bounds = np.linspace(0, parameters['channels'], number_of_lf_workers + 1).astype(int)
+    lf_channel_ranges = [range(bounds[i], bounds[i+1]) for i in range(number_of_lf_workers)]
+    lf_rings = [SharedAudioRing(buffer_parameters['lfRingSlots'], (len(channels), parameters['chunkSize']),
+                                parameters['transportFormat'])
+                for channels in lf_channel_ranges]
+    hf_ring = SharedAudioRing(buffer_parameters['hfRingSlots'], (parameters['hfNumberOfSamples'],),
+                              parameters['transportFormat'])
+    rings = [*lf_rings, hf_ring]
+    channel_settings = SharedChannelSettings(parameters['instruments'])
+    if buffer_parameters['lockRingsInMemory'] and not all([ring.lock_in_memory() for ring in rings]):
+        ut.print_warning("Couldn't lock the audio rings in memory (check the locked memory limit with ulimit -l)")
+
+    number_of_workers = number_of_lf_workers + cpu_parameters['numHfCores'] + 1
+    if cpu_parameters['pinWorkers']:  # Gives each worker its own core (the producer gets the first one)
+        cores = ut.get_worker_cores(number_of_workers)
+    else:
+        cores = [None] * number_of_workers
 
     processes = []  # Initializes processes based on the number of wanted parallel workers
-    for _ in range(cpu_parameters['numLfCores']):
+    for i in range(number_of_lf_workers):
         processes.append(Process(target=lf_audio_consumer, args=(
-            lf_queue,
-            settings_queue,
+            lf_rings[i],
+            channel_settings,
+            lf_channel_ranges[i],
             parameters,
+            cores[1 + i],
         )))
-    for _ in range(cpu_parameters['numHfCores']):
+    for i in range(cpu_parameters['numHfCores']):
         processes.append(Process(target=hf_audio_consumer, args=(
-            hf_queue,
+            hf_ring,
             parameters,
+            cores[1 + number_of_lf_workers + i],
         )))
 
-    processes.append(Process(target=audio_producer, args=(
+    producer = Thread(target=audio_producer, args=(
         audio_producer_object,
         control_event,
-        lf_queue,
-        hf_queue,
+        lf_rings,
+        lf_channel_ranges,
+        hf_ring,
         parameters,
-    )))
+        cores[0],
+    ), daemon=True)
 
     for p in processes:  # Starts processes
         p.start()
-
-    for p in processes:  # Waits for processes to end
-        p.join()
+    producer.start()  # Started after the workers, so that they aren't forked with its streams
+
+    try:
+        producer.join()
+        for p in processes:  # Waits for processes to end
+            p.join()
+    except KeyboardInterrupt:
+        ut.print_info("Stopping...")
+        control_event.set()  # The producer closes both rings, and each consumer ends once it has read them
+        producer.join()
+        for p in processes:
+            p.join()
+
+    lf_dropped = sum([ring.get_dropped() for ring in lf_rings])
+    if lf_dropped or hf_ring.get_dropped():
+        ut.print_warning("Dropped " + str(lf_dropped) + " LF chunks and " + str(hf_ring.get_dropped()) + " HF chunks")
+
+    for ring in rings:  # Releases the shared memory blocks
+        ring.unlink()
+    ut.flush_logs()
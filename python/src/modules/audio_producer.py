@@ -3,6 +3,8 @@ import pyaudio
 import numpy as np
 import time
 import modules.custom_exceptions as ce
+import modules.utilities as ut
+from modules.kernels import downmix
 
 
 class AudioProducer(ABC):
@@ -24,18 +26,18 @@ class AudioProducer(ABC):
 
         `_sample_format`: Format at which to read and write audio (float, int, ...).
 
-        `_np_format`: Format of numpy used for conversions.
+        `_np_format`: Format of numpy of the produced chunks (the format in which audio is moved between processes).
 
         `_channels`: Number of channels of the audio source.
         """
         self._sample_rate = parameters['sampleRate']
         self._chunk_size = parameters['chunkSize']
         self._sample_format = parameters['sampleFormat']
-        self._np_format = parameters['npFormat']
+        self._np_format = parameters['transportFormat']
         self._channels = parameters['channels']
 
     @abstractmethod
-    def get_next_chunk(self, in_stream: pyaudio.Stream, out_stream: pyaudio.Stream) -> list:
+    def get_next_chunk(self, in_stream: pyaudio.Stream, out_stream: pyaudio.Stream, out: np.ndarray) -> np.ndarray:
         """Abstract function to get the next chunk of audio from an input stream.
 
         **Args:**
@@ -44,9 +46,11 @@ class AudioProducer(ABC):
 
         `out_stream`: Output stream used to playback audio in recorded applications.
 
+        `out`: Preallocated array of shape `(channels, chunk_size)` in which to write the chunk.
+
         **Returns:**
 
-        A representation of the next chunk of audio read by the input device.
+        The `out` array, filled with the next chunk of audio read by the input device.
         """
         pass
 
@@ -64,7 +68,7 @@ class LiveAudioProducer(AudioProducer):
         """
         super().__init__(parameters)
         
-    def get_next_chunk(self, in_stream: pyaudio.Stream, out_stream: pyaudio.Stream) -> list:
+    def get_next_chunk(self, in_stream: pyaudio.Stream, out_stream: pyaudio.Stream, out: np.ndarray) -> np.ndarray:
         """Gets the next chunk of audio from the input stream.
 
         **Args:**
@@ -73,22 +77,40 @@ class LiveAudioProducer(AudioProducer):
 
         `out_stream`: Output stream used to playback audio in recorded applications.
 
+        `out`: Preallocated array of shape `(channels, chunk_size)` in which to write the chunk.
+
         **Returns:**
 
-        The next chunk of audio read by the input stream, divided for each track of the input sound card.
+        The `out` array, filled with the next chunk of audio read by the input stream and divided for each track of
+        the input sound card.
         """
-        data_per_channel = []
-
         if in_stream is None: 
             raise ce.AudioProducingException("Input stream was None")
         
         chunk_bytes = in_stream.read(self._chunk_size, False)  # Reads from input stream
-        chunk_array = np.frombuffer(chunk_bytes, dtype=self._np_format)  # Converts to numpy array
 
-        for i in range(self._channels):  # Divides master audio chunk into channels
-            data_per_channel.append(chunk_array[i::self._channels])
+        return self.write_chunk(chunk_bytes, out)
 
-        return data_per_channel
+    def write_chunk(self, chunk_bytes: bytes, out: np.ndarray) -> np.ndarray:
+        """Divides interleaved audio coming from the input sound card into its tracks. Used both after blocking reads
+        and by the stream callback of live audio.
+
+        **Args:**
+
+        `chunk_bytes`: Interleaved audio samples of all tracks.
+
+        `out`: Preallocated array of shape `(channels, chunk_size)` in which to write the chunk.
+
+        **Returns:**
+
+        The `out` array, filled with the chunk divided for each track of the input sound card.
+        """
+        chunk_array = np.frombuffer(chunk_bytes, dtype=self._np_format)  # Converts to numpy array (no copy)
+
+        # Deinterleaves all channels with a single copy into contiguous rows of `out`
+        np.copyto(out, chunk_array.reshape(self._chunk_size, self._channels).T)
+
+        return out
 
 
 class RecordedAudioProducer(AudioProducer):
@@ -108,13 +130,25 @@ class RecordedAudioProducer(AudioProducer):
         a song's folder.
 
         `_audio_playback`: Whether the user wants to play back the song as it's being processed.
+
+        `_playback_chunk`: Preallocated buffer containing the mono mixdown of the chunk being played back.
+
+        `_position`: Index of the first sample of the next chunk, shared by all tracks.
+
+        `_chunk_duration`: Duration of a chunk of audio in seconds.
+
+        `_next_deadline`: Monotonic time at which the next chunk is due (`None` before the first chunk).
         """
         super().__init__(parameters)
 
-        self._audio_input_tracks = parameters['tracks']
+        self._audio_input_tracks = [np.ascontiguousarray(track) for track in parameters['tracks']]
         self._audio_playback = parameters['audioPlayback']
+        self._playback_chunk = ut.aligned_empty(self._chunk_size, np.float32)
+        self._position = 0
+        self._chunk_duration = self._chunk_size / self._sample_rate
+        self._next_deadline = None
 
-    def get_next_chunk(self, in_stream: pyaudio.Stream, out_stream: pyaudio.Stream) -> list:
+    def get_next_chunk(self, in_stream: pyaudio.Stream, out_stream: pyaudio.Stream, out: np.ndarray) -> np.ndarray:
         """Gets the next chunk of audio from audio files of tracks.
 
         **Args:**
@@ -123,32 +157,48 @@ class RecordedAudioProducer(AudioProducer):
 
         `out_stream`: Output stream used to playback audio in recorded applications.
 
+        `out`: Preallocated array of shape `(channels, chunk_size)` in which to write the chunk.
+
         **Returns:**
 
-        The next chunk of audio read by the input stream, divided for each track (which are stored in
-        different files).
+        The `out` array, filled with the next chunk of audio divided for each track (which are stored in different
+        files). The last chunk of a track is padded with zeros.
         """
-        data_per_channel = []
+        data_per_channel = out
         cs = self._chunk_size
+        start = self._position
         
-        for i in range(len(self._audio_input_tracks)):
-            if len(self._audio_input_tracks[i]) == 0:
+        for i, track in enumerate(self._audio_input_tracks):  # Copies from a view of each track, without slicing it
+            remaining = len(track) - start
+            if remaining <= 0:
                 raise ce.FinishedSongException("Tried to access finished song")
-            if len(self._audio_input_tracks[i]) < cs:
-                data_per_channel.append(self._audio_input_tracks[i].copy())
-                self._audio_input_tracks[i] = []
+            if remaining < cs:
+                data_per_channel[i, :remaining] = track[start:]
+                data_per_channel[i, remaining:] = 0
                 continue
-            data_per_channel.append(self._audio_input_tracks[i][0:cs])
-            self._audio_input_tracks[i] = self._audio_input_tracks[i][cs:len(self._audio_input_tracks[i])]
+            data_per_channel[i] = track[start:start+cs]
+        self._position = start + cs
 
         if out_stream:  # Plays audio if the user choose to do so during startup
             self.__play_audio_chunk(data_per_channel, out_stream)
-        else:  # Waits for chunk_size/sample_rate otherwise (to mimic live audio behaviour)
-            time.sleep(np.abs(cs/self._sample_rate))
+        else:  # Waits until the chunk is due otherwise (to mimic live audio behaviour)
+            self.__wait_for_deadline()
 
         return data_per_channel
 
-    def __play_audio_chunk(self, data_per_channel: list, out_stream: pyaudio.Stream):
+    def __wait_for_deadline(self):
+        """Sleeps until the next chunk is due. Deadlines are spaced by exactly one chunk from the first one, so the
+        time spent producing each chunk doesn't make the song drift.
+        """
+        now = time.monotonic()
+        if self._next_deadline is None:
+            self._next_deadline = now
+        self._next_deadline += self._chunk_duration
+        delay = self._next_deadline - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def __play_audio_chunk(self, data_per_channel: np.ndarray, out_stream: pyaudio.Stream):
         """Plays a given chunk of audio on an output stream.
 
         **Args:**
@@ -157,7 +207,7 @@ class RecordedAudioProducer(AudioProducer):
 
         `out_stream`: Output stream used to play the audio chunk.
         """
-        np_data = np.array(data_per_channel, dtype=np.float32, copy=True)
-        np_data = np_data.sum(axis=0) / float(len(data_per_channel))
+        # Mixes down all tracks in one pass into the preallocated buffer
+        downmix(data_per_channel, self._playback_chunk)
 
-        out_stream.write(np_data.tobytes(order='C'))
+        out_stream.write(self._playback_chunk.tobytes())
@@ -1,19 +1,28 @@
 from abc import ABC, abstractmethod
 import os
+import math
 import logging
 import multiprocessing as mp
 import warnings
 import numpy as np
 import librosa
+import scipy.fft
+import scipy.signal
 import tensorflow as tf
 import modules.default_parameters as dp
-from scipy.signal import find_peaks
 import modules.utilities as ut
+from modules.kernels import channels_rms, channels_peak, frame_and_window, spectral_features, parabolic_peaks
 from modules.connection import OSCConnectionHandler, LFAudioMessage, HFAudioMessage
 
 # Removes Tensorflow logs and warnings
 tf.keras.utils.disable_interactive_logging()
 tf.get_logger().setLevel(logging.ERROR)
+warnings.filterwarnings('ignore', module='keras')
+warnings.filterwarnings('ignore', module='tensorflow')
+
+# Removes librosa warnings once, instead of saving and restoring the warning filters for every frame
+warnings.filterwarnings('ignore', category=UserWarning, module='librosa')
+warnings.filterwarnings('ignore', category=FutureWarning, module='librosa')
 
 
 class AudioProcessor(ABC):
@@ -34,9 +43,9 @@ class AudioProcessor(ABC):
 
         `_chunk_size`: Size of the chunk of audio to read.
 
-        `_np_format`: Numpy format used to process audio.
+        `_np_format`: Numpy format used to process audio, always single precision.
 
-        `_nfft`: Size of the FFT used during processing.
+        `_nfft`: Size of the FFT used during processing, rounded up to the closest size the FFT handles quickly.
 
         `_hop_length`: Hop Length of the FFT used during processing.
 
@@ -48,16 +57,59 @@ class AudioProcessor(ABC):
         pitch extraction is discarded.
 
         `_normType`: Normalization type used during processing.
+
+        `_normalize`: Normalization function of `_normType`, called as `_normalize(array, out=None)`.
+
+        `_fft_frequencies`: Center frequency of each bin of the FFT, computed once for all frames.
+
+        `_window`: Window of the STFT, zero-padded to `_nfft` and computed once for all frames.
+
+        `_instrument_bins`: Range of FFT bins covering the fundamental frequencies of each instrument.
+
+        `_scratch`: Preallocated arrays reused by the STFT between calls, by name.
+
+        `_fft_workers`: Number of threads used by the FFT, one for each core the process is allowed to run on.
+
+        `_tonality_threshold`: Ratio between the loudest and the mean magnitude of the bins of an instrument under which
+        a frame is considered not tonal, and no pitch is searched.
+
+        `_peak_pitches`: Preallocated array in which the frequencies of the loudest peaks of a frame are written.
+
+        `_peak_magnitudes`: Preallocated array in which the magnitudes of the loudest peaks of a frame are written.
         """
         self._sample_rate = parameters['sampleRate']
         self._chunk_size = parameters['chunkSize']
-        self._np_format = parameters['npFormat']
-        self._nfft = parameters['nfft']
+        self._np_format = np.dtype(np.float32)  # Twice the SIMD lanes and half the memory traffic of double precision
+        if np.dtype(parameters['npFormat']) != self._np_format:
+            ut.print_warning("Processing audio as float32 instead of " + str(np.dtype(parameters['npFormat'])))
+        self._nfft = scipy.fft.next_fast_len(parameters['nfft'], real=True)
         self._hop_length = parameters['hopLength']
-        self._window_size = parameters['winSize']
+        self._window_size = min(parameters['winSize'], self._nfft)
+        if self._nfft != parameters['nfft']:
+            ut.print_warning("Using an FFT size of " + str(self._nfft) + " instead of " + str(parameters['nfft']))
         self._window_type = parameters['winType']
         self._p_threshold = parameters['pitchThreshold']
+        self._tonality_threshold = parameters['tonalityThreshold']
         self._normType = parameters['normType']
+        self._normalize = {  # Resolved once, instead of comparing the normalization type on every frame
+            ut.Normalizations.NONE: self._normalize_none,
+            ut.Normalizations.PEAK: self._normalize_peak,
+            ut.Normalizations.RMS: self._normalize_rms,
+            ut.Normalizations.Z_SCORE: self._normalize_z_score,
+            ut.Normalizations.MIN_MAX: self._normalize_min_max,
+        }[self._normType]
+        self._fft_frequencies = np.fft.rfftfreq(self._nfft, d=1.0/self._sample_rate).astype(self._np_format)
+        window = librosa.filters.get_window(self._window_type, self._window_size, fftbins=True)
+        self._window = librosa.util.pad_center(window, size=self._nfft).astype(self._np_format)
+        self._scratch = {}
+        self._fft_workers = ut.available_cores()
+        self._peak_pitches = np.zeros(4, dtype=np.float64)  # Only the four loudest pitches are sent
+        self._peak_magnitudes = np.zeros(4, dtype=np.float64)
+        self._instrument_bins = {}
+        for inst in ut.Instruments:
+            freq_range = inst.get_fundamental_frequency_range()
+            if freq_range is not None:
+                self._instrument_bins[inst] = tuple(np.searchsorted(self._fft_frequencies, freq_range))
         
     @abstractmethod
     def process(self, frame, inst: ut.Instruments):
@@ -71,49 +123,148 @@ class AudioProcessor(ABC):
         """
         pass
 
+    def process_batch(self, frames, instruments: list) -> list:
+        """Processes several audio frames at once. Subclasses can override it to vectorize the processing, by default
+        each frame is processed on its own.
+
+        **Args:**
+
+        `frames`: Audio frames to process, with shape `(frames, samples)`.
+
+        `instruments`: Instrument assigned to the track of each frame.
+
+        **Returns:**
+
+        A `list` containing the result of `process` for each frame.
+        """
+        return [self.process(frame, inst) for frame, inst in zip(frames, instruments)]
+
     def _compute_stft(self, frame):
-        """Computes the STFT of a given signal frame, with the object's parameters.
+        """Computes the magnitude of the STFT of a given signal frame (or stack of frames), with the object's
+        parameters. Frames are centered and zero-padded as in `librosa.stft`, but the window is computed only once, the
+        windowed frames are written by a single compiled kernel and the arrays are reused between calls.
 
         **Args:**
 
-        `frame`: Audio frame to process.
+        `frame`: Audio frame to process, with shape `(..., samples)`.
+
+        **Returns:**
+
+        The magnitude of the STFT with shape `(..., bins, stft_frames)`, valid until the next call.
+        """
+        frames = frame.reshape(-1, frame.shape[-1])
+        count, samples = frames.shape
+        stft_frames = 1 + (samples + 2*(self._nfft // 2) - self._nfft) // self._hop_length
+
+        windowed = self._get_scratch('windowed', (count, stft_frames, self._nfft), self._np_format)
+        frame_and_window(frames, self._window, self._hop_length, windowed)
+
+        spectrum = scipy.fft.rfft(windowed, axis=-1, overwrite_x=True, workers=self._fft_workers)
+        magnitude = self._get_scratch('magnitude', spectrum.shape, self._np_format)
+        np.abs(spectrum, out=magnitude)
+        return np.swapaxes(magnitude, -1, -2).reshape(*frame.shape[:-1], *magnitude.shape[:0:-1])
+
+    def _get_scratch(self, name: str, shape: tuple, dtype) -> np.ndarray:
+        """Returns a preallocated array with the given shape. The memory is reused between calls and reallocated only
+        when more rows (or a different row shape) are needed.
+
+        **Args:**
+
+        `name`: Name of the array.
+
+        `shape`: Shape of the array.
+
+        `dtype`: Numpy format of the array.
+
+        **Returns:**
+
+        A view of the preallocated array with the given shape.
         """
-        return np.abs(librosa.stft(y=frame, n_fft=self._nfft, hop_length=self._hop_length, win_length=self._window_size, window=self._window_type, dtype=self._np_format))
+        scratch = self._scratch.get(name)
+        if scratch is None or scratch.shape[1:] != shape[1:] or len(scratch) < shape[0] or scratch.dtype != dtype:
+            scratch = ut.aligned_empty(shape, dtype)
+            self._scratch[name] = scratch
+        return scratch[:shape[0]]
 
-    def _get_mono_frequency(self, frame):
-        """Returns the peak frequency of the audio frame (Monophonic Pitch Detection).
+    def _get_mono_frequency(self, frame, signal_stft=None):
+        """Returns the peak frequency of the audio frame (Monophonic Pitch Detection). The loudest local maximum of the
+        spectrum is taken: being the loudest, it's never discarded by a minimum distance between peaks, so there's no
+        need to filter the other ones out.
 
         **Args:**
 
         `frame`: Audio frame to process.
+
+        `signal_stft`: Spectrum of the frame, if already computed. Its first stft frame is used instead of computing
+        another FFT of the whole frame.
+
+        **Returns:**
+
+        The frequency of the peak in Hz (0 if the spectrum has no peaks).
         """
-        spectrum = np.abs(np.fft.rfft(frame))
-        peaks, _ = find_peaks(spectrum, distance=10)
+        if signal_stft is not None:
+            spectrum = signal_stft[:, 0]
+            bin_width = self._sample_rate / self._nfft
+        else:
+            spectrum = np.abs(scipy.fft.rfft(frame))  # Keeps single precision, unlike np.fft
+            bin_width = self._sample_rate / frame.shape[-1]
+        center = spectrum[1:-1]
+        peaks = np.flatnonzero((center > spectrum[:-2]) & (center >= spectrum[2:])) + 1
         
         if len(peaks) == 0:
             return 0
         
         peak_index = np.argmax(spectrum[peaks])
-        return peaks[peak_index] * self._sample_rate / self._sample_rate
+        return peaks[peak_index] * bin_width
 
     def _get_poly_frequencies(self, signal_stft, inst: ut.Instruments):
-        """Returns the peak frequencies of the audio frame from its spectrum (Polyphonic Pitch Detection).
+        """Returns the peak frequencies of the audio frame from its spectrum (Polyphonic Pitch Detection). Peaks are
+        searched by a compiled kernel with the same rules of `librosa.piptrack` (local maxima above a threshold relative
+        to the loudest bin, refined with parabolic interpolation), but only in the first stft frame and inside the
+        precomputed bin range of the instrument. Frames without a prominent peak in that range are skipped.
 
         **Args:**
 
         `signal_stft`: Spectrum of the frame to process.
 
         `inst`: Instrument that generated the processed audio frame.
+
+        **Returns:**
+
+        The frequencies of the loudest peaks (at most as many as `_peak_pitches`), sorted from the loudest to the
+        quietest and valid until the next call.
         """
-        freq_range = inst.get_fundamental_frequency_range()
-        if range is None:
-            return [0]
+        bins = self._instrument_bins.get(inst)
+        if bins is None:
+            return np.zeros(1, dtype=self._np_format)
+
+        band = signal_stft[bins[0]:bins[1], 0]
+        if len(band) == 0 or np.max(band) < self._tonality_threshold * np.mean(band):  # No prominent peak to pick
+            return self._peak_pitches[:0]
+
+        count = parabolic_peaks(signal_stft[:, 0], bins[0], bins[1], self._p_threshold, self._sample_rate / self._nfft,
+                                self._peak_pitches, self._peak_magnitudes)
+        return self._peak_pitches[:count]
 
-        pitches, magnitudes = librosa.piptrack(S=signal_stft, sr=self._sample_rate, fmin=freq_range[0], fmax=freq_range[1], threshold=self._p_threshold)
-        indexes = np.argsort(magnitudes[:, 0])[::-1]
-        pitches = pitches[indexes, 0]
+    def _compute_all_spectral(self, signal_stft) -> tuple:
+        """Computes the spectral centroid, bandwidth, flatness and rolloff of the audio frame from its spectrum in a
+        single compiled kernel, sharing the intermediate results between features (with the same definitions used by
+        librosa).
 
-        return pitches[pitches > 0]
+        **Args:**
+
+        `signal_stft`: Spectrum of the frame to process, with shape `(..., bins, stft_frames)`.
+
+        **Returns:**
+
+        A `tuple` containing the mean value over the stft frames of the centroid, bandwidth, flatness and rolloff
+        (each with shape `(...)`), valid until the next call.
+        """
+        spectra = signal_stft.reshape(-1, *signal_stft.shape[-2:])
+        features = self._get_scratch('spectral', (len(spectra), 4), self._np_format)
+        spectral_features(spectra, self._fft_frequencies, features)
+        features = features.reshape(*signal_stft.shape[:-2], 4)
+        return features[..., 0], features[..., 1], features[..., 2], features[..., 3]
 
     def _get_spectral_centroid(self, signal_stft):
         """Returns the mean value of the spectral centroid of the audio frame from its spectrum.
@@ -123,7 +274,7 @@ class AudioProcessor(ABC):
         `signal_stft`: Spectrum of the frame to process.
         """
         cent = librosa.feature.spectral_centroid(S=signal_stft, sr=self._sample_rate, n_fft=self._nfft, hop_length=self._hop_length, win_length=self._window_size, window=self._window_type)
-        cent = np.mean(cent, axis=1)
+        cent = np.mean(cent, axis=-1)
         return cent
 
     def _get_spectral_bandwidth(self, signal_stft):
@@ -134,7 +285,7 @@ class AudioProcessor(ABC):
         `signal_stft`: Spectrum of the frame to process.
         """
         sb = librosa.feature.spectral_bandwidth(S=signal_stft, sr=self._sample_rate, n_fft=self._nfft, hop_length=self._hop_length, win_length=self._window_size, window=self._window_type)
-        sb = np.mean(sb, axis=1)
+        sb = np.mean(sb, axis=-1)
         return sb
 
     def _get_spectral_contrast(self, signal_stft):
@@ -146,7 +297,7 @@ class AudioProcessor(ABC):
         `signal_stft`: Spectrum of the frame to process.
         """
         sc = librosa.feature.spectral_contrast(S=signal_stft, sr=self._sample_rate, n_fft=self._nfft, hop_length=self._hop_length, win_length=self._window_size, window=self._window_type)
-        return np.mean(sc, axis=1)
+        return np.mean(sc, axis=-1)
 
     def _get_spectral_flatness(self, signal_stft):
         """Returns the mean value of the spectral flatness of the audio frame from its spectrum.
@@ -156,7 +307,7 @@ class AudioProcessor(ABC):
         `signal_stft`: Spectrum of the frame to process.
         """
         sf = librosa.feature.spectral_flatness(S=signal_stft, n_fft=self._nfft, hop_length=self._hop_length, win_length=self._window_size, window=self._window_type)
-        return np.mean(sf, axis=1)
+        return np.mean(sf, axis=-1)
 
     def _get_spectral_rolloff(self, signal_stft):
         """Returns the spectral rolloff of the audio frame from its spectrum.
@@ -166,35 +317,111 @@ class AudioProcessor(ABC):
         `signal_stft`: Spectrum of the frame to process.
         """
         sr = librosa.feature.spectral_rolloff(S=signal_stft, sr=self._sample_rate, n_fft=self._nfft, hop_length=self._hop_length, win_length=self._window_size, window=self._window_type)
-        return np.mean(sr, axis=1)
+        return np.mean(sr, axis=-1)
     
-    def _normalize(self, array) -> np.ndarray:
-        """Implements different normalizations based on the current selected normalization type.
+    def _normalize_none(self, array, out=None) -> np.ndarray:
+        """Leaves the array as is (`Normalizations.NONE`).
 
         **Args:**
 
-        `array`: Array to normalize
+        `array`: Array to normalize, with shape `(..., samples)`.
+
+        `out`: Array in which to write the result (can be `array` itself), or `None` to return `array`.
 
         **Returns:**
 
-        The normalized array (or the array as is if normalization is set to NONE).
+        The array.
         """
-        if self._normType == ut.Normalizations.NONE:
+        if out is None or out is array:
             return array
-        
-        if self._normType == ut.Normalizations.PEAK:
-            return array / np.max(np.abs(array))
-        
-        if self._normType == ut.Normalizations.RMS:
-            return np.sqrt(np.mean(np.square(array)))
-        
-        if self._normType == ut.Normalizations.Z_SCORE:
-            return (array - np.mean(array)) / np.std(array)
-        
-        if self._normType == ut.Normalizations.MIN_MAX:
-            min_value = np.amin(array)
-            max_value = np.amax(array)
-            return (array - min_value) / (max_value - min_value)
+        np.copyto(out, array)
+        return out
+
+    def _normalize_peak(self, array, out=None) -> np.ndarray:
+        """Divides each frame by its highest absolute value (`Normalizations.PEAK`).
+
+        **Args:**
+
+        `array`: Array to normalize, with shape `(..., samples)`.
+
+        `out`: Array in which to write the result (can be `array` itself), or `None` to allocate a new one.
+
+        **Returns:**
+
+        The normalized array.
+        """
+        frames = array.reshape(-1, array.shape[-1])
+        peaks = self._get_scratch('peaks', (len(frames), 1), frames.dtype)
+        channels_peak(frames, peaks.reshape(-1))
+        return self.__divide(array, peaks.reshape(*array.shape[:-1], 1), out)
+
+    def _normalize_rms(self, array, out=None) -> np.ndarray:
+        """Divides each frame by its rms (`Normalizations.RMS`).
+
+        **Args:**
+
+        `array`: Array to normalize, with shape `(..., samples)`.
+
+        `out`: Array in which to write the result (can be `array` itself), or `None` to allocate a new one.
+
+        **Returns:**
+
+        The normalized array.
+        """
+        return self.__divide(array, np.sqrt(np.mean(np.square(array), axis=-1, keepdims=True)), out)
+
+    def _normalize_z_score(self, array, out=None) -> np.ndarray:
+        """Removes the mean of each frame and divides it by its standard deviation (`Normalizations.Z_SCORE`).
+
+        **Args:**
+
+        `array`: Array to normalize, with shape `(..., samples)`.
+
+        `out`: Array in which to write the result (can be `array` itself), or `None` to allocate a new one.
+
+        **Returns:**
+
+        The normalized array.
+        """
+        std = np.std(array, axis=-1, keepdims=True)
+        out = np.subtract(array, np.mean(array, axis=-1, keepdims=True), out=out)
+        return self.__divide(out, std, out)
+
+    def _normalize_min_max(self, array, out=None) -> np.ndarray:
+        """Scales each frame between 0 and 1 (`Normalizations.MIN_MAX`).
+
+        **Args:**
+
+        `array`: Array to normalize, with shape `(..., samples)`.
+
+        `out`: Array in which to write the result (can be `array` itself), or `None` to allocate a new one.
+
+        **Returns:**
+
+        The normalized array.
+        """
+        min_value = np.amin(array, axis=-1, keepdims=True)
+        value_range = np.amax(array, axis=-1, keepdims=True) - min_value
+        out = np.subtract(array, min_value, out=out)
+        return self.__divide(out, value_range, out)
+
+    def __divide(self, array, scale, out) -> np.ndarray:
+        """Divides each frame by its scale, leaving the frames with a null scale (e.g. silent ones) as they are.
+
+        **Args:**
+
+        `array`: Array to divide, with shape `(..., samples)`.
+
+        `scale`: Scale of each frame, with shape `(..., 1)`.
+
+        `out`: Array in which to write the result, or `None` to allocate a new one.
+
+        **Returns:**
+
+        The divided array.
+        """
+        scale[scale < np.finfo(self._np_format).tiny] = 1
+        return np.divide(array, scale, out=out)
 
 
 class DefaultAudioProcessor(AudioProcessor):
@@ -221,19 +448,43 @@ class DefaultAudioProcessor(AudioProcessor):
 
         **Returns:**
 
-        Low-level Features as floats ordered inside an array.
+        Low-level Features as floats ordered inside an array, valid until the next call.
         """
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            frame = librosa.util.normalize(frame)
-            signal_stft = self._compute_stft(frame)
-            pitches = np.round(self._get_poly_frequencies(signal_stft, inst))
-            spec_centroid = np.round(self._get_spectral_centroid(signal_stft)[0])
-            spec_bandwidth = np.round(self._get_spectral_bandwidth(signal_stft)[0])
-            spec_flatness = self._get_spectral_flatness(signal_stft)[0]
-            spec_rolloff = np.round(self._get_spectral_rolloff(signal_stft)[0])
+        return self.process_batch(frame[np.newaxis], [inst])[0]
+
+    def process_batch(self, frames, instruments: list) -> list:
+        """Processes several audio frames, computing the STFT and the spectral features of all frames with a single
+        call each. Features are written into a single preallocated array, with a row for each frame.
 
-        return [spec_centroid, spec_bandwidth, spec_flatness, spec_rolloff, *pitches[:4]]
+        **Args:**
+
+        `frames`: Audio frames to process, with shape `(frames, samples)`.
+
+        `instruments`: Instrument of the track of each frame.
+
+        **Returns:**
+
+        A `list` containing the Low-level Features of each frame (centroid, bandwidth, flatness, rolloff and up to four
+        pitches), as views of the preallocated array valid until the next call.
+        """
+        features = self._get_scratch('features', (len(frames), 8), self._np_format)
+        lengths = [4] * len(frames)
+        normalized = self._get_scratch('normalized', frames.shape, self._np_format)
+        np.copyto(normalized, frames)  # Copied into memory of its own, so it's normalized in place
+        frames = self._normalize(normalized, out=normalized)
+        signal_stft = self._compute_stft(frames)  # Shape (frames, bins, stft_frames)
+        spec_centroid, spec_bandwidth, spec_flatness, spec_rolloff = self._compute_all_spectral(signal_stft)
+        features[:, 0] = np.round(spec_centroid)
+        features[:, 1] = np.round(spec_bandwidth)
+        features[:, 2] = spec_flatness
+        features[:, 3] = np.round(spec_rolloff)
+
+        for index, instrument in enumerate(instruments):  # Pitch tracking depends on the instrument of each frame
+            pitches = self._get_poly_frequencies(signal_stft[index], instrument)
+            lengths[index] = 4 + len(pitches)
+            np.round(pitches, out=features[index, 4:lengths[index]])
+
+        return [row[:length] for row, length in zip(features, lengths)]
 
 
 class InputHandler(ABC):
@@ -258,21 +509,23 @@ class InputHandler(ABC):
 
         `_signal_threshold`: Threshold under which the signal is considered to be null.
 
-        `__instrument`: Instrument of the source of audio.
+        `_signal_threshold_sq`: Square of `_signal_threshold`, compared with the mean square of the signal so that no
+        square root is needed.
 
-        `_lock`: Mutex lock used for synchronization purposes.
+        `__instrument`: Shared index of the instrument of the source of audio. Read and written without a lock, as it's
+        a single aligned integer.
 
         `channel`: Number assigned to the track that this object is currently processing.
 
-        `__priority`: Number to indicate the priority value of an instance with respect to the other instances.
+        `__priority`: Shared number to indicate the priority value of an instance with respect to the other instances.
         """
         net_params = dp.NET_PARAMETERS
         self._connection_handler = OSCConnectionHandler.get_instance(net_params['outNetAddress'], net_params['outNetPort'])
         self._signal_threshold = parameters['signalThreshold']
-        self.__instrument = instrument
-        self._lock = mp.Lock()
+        self._signal_threshold_sq = self._signal_threshold ** 2
+        self.__instrument = mp.Value('i', instrument.value, lock=False)
         self.channel = channel
-        self.__priority = 0
+        self.__priority = mp.Value('i', 0, lock=False)
 
     @abstractmethod
     def process(self, data):
@@ -285,54 +538,44 @@ class InputHandler(ABC):
         pass
 
     def set_instrument(self, instrument: ut.Instruments):
-        """Synchronized setter for the `__instrument` attribute.
+        """Setter for the `__instrument` attribute.
 
         **Args:**
 
         `instrument`: New instrument to assign.
         """
-        self._lock.acquire()
-        self.__instrument = instrument
-        self._lock.release()
+        self.__instrument.value = instrument.value
 
     def get_instrument(self) -> ut.Instruments:
-        """Synchronized getter for the `__instrument` attribute.
+        """Getter for the `__instrument` attribute.
 
         **Returns:**
 
         The instrument assigned to this handler.
         """
-        self._lock.acquire()
-        inst = self.__instrument
-        self._lock.release()
-        return inst
+        return ut.Instruments(self.__instrument.value)
     
     def set_priority(self, priority: int):
-        """Synchronized setter for the `__priority` attribute.
+        """Setter for the `__priority` attribute.
 
         **Args:**
 
         `priority`: New priority to assign.
         """
-        self._lock.acquire()
-        self.__priority = priority
-        self._lock.release()
+        self.__priority.value = priority
 
     def get_priority(self) -> int:
-        """Synchronized getter for the `__priority` attribute.
+        """Getter for the `__priority` attribute.
 
         **Returns:**
 
         The priority assigned to this handler.
         """
-        self._lock.acquire()
-        p = self.__priority
-        self._lock.release()
-        return p
+        return self.__priority.value
 
     def _no_signal(self, data):
-        """Checks if there's an actual signal inside the audio frame by computing the rms and evaluating it against a
-        predefined threshold.
+        """Checks if there's an actual signal inside the audio frame by evaluating its rms against a predefined
+        threshold. The sum of squares is computed as a single BLAS dot product and compared with the squared threshold.
 
         **Args:**
 
@@ -342,8 +585,8 @@ class InputHandler(ABC):
 
         A `bool` set to `True` if the signal is virtually non-existent.
         """
-        rms = np.sqrt(np.mean(np.square(data)))
-        return rms <= self._signal_threshold
+        samples = data.reshape(-1)  # A view, as frames are contiguous
+        return np.dot(samples, samples) <= self._signal_threshold_sq * samples.size
     
     def handle_settings(self, settings):
         """Handles incoming settings.
@@ -394,6 +637,111 @@ class LFAudioInputHandler(InputHandler):
         self._connection_handler.send_message(msg)
 
 
+class LFAudioInputHandlerBatch:
+    """Handles the Low-level feature processing of all the channels of either live or recorded audio at once. The
+    state of the channels is kept as one array per field (instead of one handler object per channel), so that checks
+    over all channels are done with a single call.
+    """
+
+    def __init__(self, parameters: dict, instruments: list, channels: range = None):
+        """Constructor for the LFAudioInputHandlerBatch class.
+
+        **Args:**
+
+        `parameters`: Audio parameters used to process the audio.
+
+        `instruments`: Instrument of each of the channels to process.
+
+        `channels`: Index of each of the channels to process, used to address their messages (all channels from 0 if
+        `None`).
+
+        **Class Attributes:**
+
+        `_connection_handler`: Object used to send features to external applications.
+
+        `_signal_threshold`: Threshold under which the signal is considered to be null.
+
+        `_instruments`: Instrument of each channel.
+
+        `_channels`: Index of each channel.
+
+        `_rms_values`: Preallocated array containing the rms of each channel of the last processed chunks, with shape
+        `(max_chunks, channels)`.
+
+        `_pcm_scale`: Factor converting integer samples coming from the producer to floats (`None` if they're floats).
+
+        `_float_batch`: Preallocated array in which integer chunks are converted to floats, with shape
+        `(max_chunks, channels, samples)` (`None` if they're floats).
+
+        `_audio_processor`: Processor object used to process audio.
+        """
+        net_params = dp.NET_PARAMETERS
+        self._connection_handler = OSCConnectionHandler.get_instance(net_params['outNetAddress'],
+                                                                     net_params['outNetPort'])
+        self._signal_threshold = parameters['signalThreshold']
+        self._instruments = list(instruments)
+        self._channels = range(len(self._instruments)) if channels is None else channels
+        self._rms_values = np.zeros((dp.BUFFER_PARAMETERS['lfBatchSize'], len(self._instruments)),
+                                    dtype=parameters['npFormat'])
+        self._pcm_scale = ut.get_pcm_scale(parameters['transportFormat'])
+        self._float_batch = None
+        if self._pcm_scale is not None:
+            shape = (dp.BUFFER_PARAMETERS['lfBatchSize'], len(self._instruments), parameters['chunkSize'])
+            self._float_batch = ut.aligned_empty(shape, parameters['npFormat'])
+        self._audio_processor = DefaultAudioProcessor(parameters)
+
+    def set_instruments(self, instruments: list):
+        """Setter for the `_instruments` attribute.
+
+        **Args:**
+
+        `instruments`: New instrument of each channel.
+        """
+        self._instruments = list(instruments)
+
+    def get_instruments(self) -> list:
+        """Getter for the `_instruments` attribute.
+
+        **Returns:**
+
+        A `list` containing the instrument of each channel.
+        """
+        return self._instruments
+
+    def process(self, data):
+        """Processes an audio frame containing all channels, skipping the channels with virtually no signal.
+
+        **Args:**
+
+        `data`: Data to process, with shape `(channels, samples)`.
+        """
+        self.process_batch(data[np.newaxis])
+
+    def process_batch(self, batch):
+        """Processes consecutive audio frames containing all channels, skipping the channels with virtually no signal.
+        The signal of every channel of every frame is checked with a single call, all the frames with a signal are
+        handed to the audio processor together and their features are sent as a single bundle.
+
+        **Args:**
+
+        `batch`: Data to process, with shape `(chunks, channels, samples)` and at most `lfBatchSize` chunks.
+        """
+        if self._pcm_scale is not None:  # Integer samples are converted once, into the preallocated float batch
+            batch = np.multiply(batch, self._pcm_scale, out=self._float_batch[:len(batch)], casting='unsafe')
+        rms_values = self._rms_values[:len(batch)]
+        channels_rms(batch.reshape(-1, batch.shape[-1]), rms_values.reshape(-1))
+        chunks, channels = np.nonzero(rms_values > self._signal_threshold)
+        if len(chunks) == 0:
+            return
+
+        instruments = [self._instruments[channel] for channel in channels]
+        features = self._audio_processor.process_batch(batch[chunks, channels], instruments)  # Gathers a copy
+        queue_message = self._connection_handler.queue_message
+        for channel, inst, processed_data in zip(channels, instruments, features):
+            queue_message(LFAudioMessage(processed_data, self._channels[channel], inst))
+        self._connection_handler.flush()  # The features of the whole batch leave with a single datagram
+
+
 class HFAudioInputHandler(InputHandler):
     """Handles the High-level feature processing of either live or recorded audio.
     """
@@ -411,20 +759,48 @@ class HFAudioInputHandler(InputHandler):
 
         **Class Attributes:**
 
+        `__pcm_scale`: Factor converting integer samples coming from the producer to floats (`None` if they're floats).
+
+        `__pcm_threshold`: `_signal_threshold` converted to integer samples (`None` if samples are floats).
+
+        `__resampling`: Upsampling and downsampling factors converting the audio to the sample rate of the neural
+        network (`None` if no resampling is needed).
+
         `__arousal_values`: Array containing previous arousal values used to compute a moving average.
 
         `__valence_values`: Array containing previous valence values used to compute a moving average.
 
+        `__average_index`: Index of the oldest value of the moving averages, which is replaced by the next prediction.
+
+        `__arousal_sum`: Running sum of `__arousal_values`.
+
+        `__valence_sum`: Running sum of `__valence_values`.
+
         `__nn_model`: Neural network model used to extract the mood from the piece of audio.
+
+        `__predict`: Compiled graph of the model, called directly instead of going through `predict`.
         """
         super().__init__(parameters, channel, instrument)
         path = os.path.join(parameters['mainPath'], "resources", "nn_models", "modelv5.h5")
         average_length = parameters['hfMovingAverageLengthInSeconds']
+        self.__pcm_scale = ut.get_pcm_scale(parameters['transportFormat'])
+        self.__pcm_threshold = None if self.__pcm_scale is None else int(self._signal_threshold / self.__pcm_scale)
+        self.__resampling = None
+        input_length = parameters['hfNumberOfSamples']
+        model_rate = parameters['hfModelSampleRate']
+        if model_rate is not None and model_rate != parameters['sampleRate']:
+            gcd = math.gcd(model_rate, parameters['sampleRate'])
+            self.__resampling = (model_rate // gcd, parameters['sampleRate'] // gcd)
+            # Length given by resample_poly
+            input_length = -(-input_length * self.__resampling[0] // self.__resampling[1])
         self.__arousal_values = np.zeros(int(average_length/0.5))
         self.__valence_values = np.zeros(int(average_length/0.5))
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            self.__nn_model = tf.keras.models.load_model(path)
+        self.__average_index = 0
+        self.__arousal_sum = 0.0
+        self.__valence_sum = 0.0
+        self.__nn_model = tf.keras.models.load_model(path)
+        input_signature = [tf.TensorSpec((None, input_length), tf.float32)]  # Traced only once
+        self.__predict = tf.function(lambda x: self.__nn_model(x, training=False), input_signature=input_signature)
     
     def process(self, data):
         """Processes an audio frame for High-level features.
@@ -433,23 +809,50 @@ class HFAudioInputHandler(InputHandler):
 
         `data`: Piece of audio to process.
         """
-        if self._no_signal(data):
+        self.process_batch(data[np.newaxis])
+
+    def process_batch(self, batch):
+        """Processes consecutive audio frames for High-level features, with a single call to the neural network. The
+        predictions are sent as a single bundle.
+
+        **Args:**
+
+        `batch`: Pieces of audio to process, with shape `(frames, samples)`.
+        """
+        # Windows with every sample under the threshold are dropped before converting them
+        if self.__pcm_scale is not None:
+            batch = batch[(batch.max(axis=-1) > self.__pcm_threshold) | (batch.min(axis=-1) < -self.__pcm_threshold)]
+            batch = np.multiply(batch, self.__pcm_scale, dtype=np.float32)
+        energy = np.einsum('ij,ij->i', batch, batch)  # Sum of squares of every window, in a single pass
+        # A copy, so the shared windows are left untouched
+        batch = batch[energy > self._signal_threshold_sq * batch.shape[-1]]
+        if len(batch) == 0:
             return
 
-        data = librosa.util.normalize(data)
-        data_tensor = np.copy(data)
-        data_tensor = np.expand_dims(data_tensor, axis=0)
+        if self.__resampling is not None:  # Silent windows were dropped first, so they aren't resampled
+            batch = scipy.signal.resample_poly(batch, *self.__resampling, axis=-1).astype(np.float32)
+        # No absolute values copy
+        peaks = np.maximum(batch.max(axis=-1, keepdims=True), -batch.min(axis=-1, keepdims=True))
+        np.divide(batch, peaks, out=batch)  # Peak normalization, in place
+        for prediction in self.__predict(batch).numpy():
+            self.__send_prediction(prediction)
+        self._connection_handler.flush()  # The predictions of the whole batch leave with a single datagram
 
-        prediction = self.__nn_model.predict(data_tensor)[0]
+    def __send_prediction(self, prediction):
+        """Smooths a prediction of the neural network with the moving averages and sends it.
 
-        self.__arousal_values[0] = prediction[0]
-        self.__valence_values[0] = prediction[1]
-        self.__arousal_values = np.roll(self.__arousal_values, -1)
-        self.__valence_values = np.roll(self.__valence_values, -1)
-        prediction[0] = np.average(self.__arousal_values)
-        prediction[1] = np.average(self.__valence_values)
+        **Args:**
 
-        ut.print_data_alt_color(channel=1, data=prediction)
+        `prediction`: Arousal and valence predicted for a piece of audio.
+        """
+        index = self.__average_index  # The newest prediction replaces the oldest one, and the sums are updated
+        self.__arousal_sum += prediction[0] - self.__arousal_values[index]
+        self.__valence_sum += prediction[1] - self.__valence_values[index]
+        self.__arousal_values[index] = prediction[0]
+        self.__valence_values[index] = prediction[1]
+        self.__average_index = (index + 1) % len(self.__arousal_values)
+        prediction[0] = self.__arousal_sum / len(self.__arousal_values)
+        prediction[1] = self.__valence_sum / len(self.__valence_values)
 
         msg = HFAudioMessage(prediction, 0)
-        self._connection_handler.send_message(msg)
+        self._connection_handler.queue_message(msg)
@@ -1,17 +1,56 @@
 from __future__ import annotations
+import errno
+import select
+import socket
+import struct
+from functools import lru_cache
 from abc import ABC, abstractmethod
-from multiprocessing import Lock
-from pythonosc import udp_client, osc_message_builder, osc_message
+from queue import SimpleQueue
+from threading import Lock, Thread
+from pythonosc import osc_message_builder, osc_message
 from pythonosc.dispatcher import Dispatcher
 import modules.utilities as ut
-import modules.custom_exceptions as ce
-from modules.default_parameters import OSC_MESSAGES_PARAMETERS
+from modules.default_parameters import OSC_MESSAGES_PARAMETERS, NET_PARAMETERS
+from modules.ipc import SharedChannelSettings
+import numpy as np
+
+
+@lru_cache(maxsize=256)
+def _osc_string(s: str) -> bytes:
+    """Encodes a string as an `OSC` string argument. Results are cached, as the same few addresses, type tags and
+    instrument names are encoded for every message.
+
+    **Args:**
+
+    `s`: String to encode.
+
+    **Returns:**
+
+    The string as bytes, null-terminated and padded with zeros to a multiple of four bytes.
+    """
+    encoded = s.encode()
+    return encoded + b'\0' * (4 - len(encoded) % 4)
+
+
+_BUNDLE_HEADER = b'#bundle\0' + struct.pack('>Q', 1)  # Time tag 1 means immediately
+_ELEMENT_SIZE = struct.Struct('>i')  # Size preceding each message of a bundle
+_MIN_BUNDLE_BYTES = 508  # Payload that fits in a single packet over any IPv4 link
+_BUNDLE_BYTES_STEP = 8
+_SEND_TIMEOUT = 0.1  # Seconds the sender thread waits for a full socket buffer before dropping a packet
 
 
 class Message(ABC):
     """Abstract Class representing the message with output data to be sent to the visualizer. Can be inherited to
     implement custom message types with custom parameters.
     """
+    _address_prefix = "/blank_ch"
+    _addresses = {}
+
+    def __init_subclass__(cls, **kwargs):
+        """Gives each message type its own cache of addresses.
+        """
+        super().__init_subclass__(**kwargs)
+        cls._addresses = {}
 
     def __init__(self, data, channel: int):
         """Constructor for the Message class.
@@ -28,11 +67,14 @@ class Message(ABC):
 
         `channel`: Index of the track or input channel.
 
-        `address`: `OSC` address of the message.
+        `address`: `OSC` address of the message, built once per channel and message type and then cached in
+        `_addresses`.
         """
         self._data = data
         self.channel = channel
-        self.address = "/blank_ch"+str(channel)
+        self.address = self._addresses.get(channel)
+        if self.address is None:
+            self.address = self._addresses[channel] = self._address_prefix + str(channel)
 
     @abstractmethod
     def to_osc(self) -> osc_message.OscMessage:
@@ -44,10 +86,31 @@ class Message(ABC):
         """
         pass
 
+    def to_dgram(self) -> bytes:
+        """Encodes the message as an `OSC` packet. Can be overridden to encode it without building the `OSC`
+        representation first.
+
+        **Returns:**
+
+        The encoded message.
+        """
+        return self.to_osc().dgram
+
+    def write_dgram(self, buffer: bytearray):
+        """Appends the message, encoded as an `OSC` packet, to a buffer. Can be overridden to encode the message
+        straight into the buffer.
+
+        **Args:**
+
+        `buffer`: Buffer to which the encoded message is appended.
+        """
+        buffer += self.to_dgram()
+
 
 class LFAudioMessage(Message):
     """Message containing Low-level Features.
     """
+    _address_prefix = "/LFmsg_ch"
 
     def __init__(self, data, channel: int, instrument: ut.Instruments):
         """Constructor for the LFAudioMessage class.
@@ -61,7 +124,6 @@ class LFAudioMessage(Message):
         `instrument`: Instrument of the channel.
         """
         super().__init__(data, channel=channel)
-        self.address = "/LFmsg_ch"+str(channel)
         self._instrument = instrument
 
     def to_osc(self) -> osc_message.OscMessage:
@@ -78,10 +140,36 @@ class LFAudioMessage(Message):
             msg.add_arg(float(d), osc_message_builder.OscMessageBuilder.ARG_TYPE_FLOAT)
         return msg.build()
 
+    def to_dgram(self) -> bytes:
+        """Encodes the message as an `OSC` packet directly, with the same arguments of `to_osc`. All features are
+        converted to big-endian floats with a single call, instead of adding them to a builder one at a time.
+
+        **Returns:**
+
+        The encoded message.
+        """
+        buffer = bytearray()
+        self.write_dgram(buffer)
+        return bytes(buffer)
+
+    def write_dgram(self, buffer: bytearray):
+        """Appends the message, encoded as in `to_dgram`, to a buffer without building intermediate packets.
+
+        **Args:**
+
+        `buffer`: Buffer to which the encoded message is appended.
+        """
+        features = np.asarray(self._data, dtype='>f4')
+        buffer += _osc_string(self.address)
+        buffer += _osc_string(',s' + 'f' * len(features))
+        buffer += _osc_string(self._instrument.get_string())
+        buffer += features.tobytes()
+
 
 class HFAudioMessage(Message):
     """Message containing High-level Features.
     """
+    _address_prefix = "/HFmsg_ch"
 
     def __init__(self, data, channel: int):
         """Constructor for the HFAudioMessage class.
@@ -93,7 +181,6 @@ class HFAudioMessage(Message):
         `channel`: Index of the track or input channel.
         """
         super().__init__(data, channel=channel)
-        self.address = "/HFmsg_ch"+str(channel)
 
     def to_osc(self) -> osc_message.OscMessage:
         """Converts message into its `OSC` representation with its own `OSC` address.
@@ -108,12 +195,47 @@ class HFAudioMessage(Message):
         
         return msg.build()
 
+    def to_dgram(self) -> bytes:
+        """Encodes the message as an `OSC` packet directly, with the same arguments of `to_osc`.
+
+        **Returns:**
+
+        The encoded message.
+        """
+        buffer = bytearray()
+        self.write_dgram(buffer)
+        return bytes(buffer)
+
+    def write_dgram(self, buffer: bytearray):
+        """Appends the message, encoded as in `to_dgram`, to a buffer. Only the features are encoded for each message,
+        the address and the type tags are cached.
+
+        **Args:**
+
+        `buffer`: Buffer to which the encoded message is appended.
+        """
+        features = np.asarray(self._data, dtype='>f4')
+        buffer += _osc_string(self.address)
+        buffer += _osc_string(',' + 'f' * len(features))
+        buffer += features.tobytes()
+
+
+class _NullLock:
+    """Lock that does nothing, used where a lock is required but the object is never shared between threads.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
 
 class ConnectionHandler(ABC):    
     """Abstract class to handle the connection between the python script and the external world. Can be inherited to
     implement custom methods of sending messages.
     """
-    def __init__(self, address: str, port: int):
+    def __init__(self, address: str, port: int, synchronized: bool = False):
         """Constructor for the ConnectionHandler class.
 
         **Args:**
@@ -122,17 +244,21 @@ class ConnectionHandler(ABC):
 
         `port`: Net port of the receiver as an int.
 
+        `synchronized`: Whether messages can be sent from several threads at once. Each worker process has its own
+        instance and sends from a single thread, so by default no lock is taken. Instances are never shared between
+        processes, so a thread lock is enough otherwise.
+
         **Class Attributes:**
 
         `_address`: Net address of the receiver as a string.
 
         `_port`: Net port of the receiver as an int.
 
-        `_lock`: Mutex lock used for synchronization purposes.
+        `_lock`: Mutex lock used for synchronization purposes (a lock doing nothing if not `synchronized`).
         """
         self._address = address
         self._port = port
-        self._lock = Lock()
+        self._lock = Lock() if synchronized else _NullLock()
 
     @staticmethod
     @abstractmethod
@@ -161,6 +287,25 @@ class ConnectionHandler(ABC):
         """
         pass
 
+    def queue_message(self, message: Message):
+        """Queues a message to be sent with the next call to `flush`. By default the message is sent right away.
+
+        **Args:**
+
+        `message`: Message to send over the network.
+        """
+        self.send_message(message)
+
+    def flush(self):
+        """Sends all the queued messages. Does nothing by default, as messages aren't queued.
+        """
+        pass
+
+    def close(self):
+        """Waits until every message has been sent and releases the connection. Does nothing by default.
+        """
+        pass
+
 
 class OSCConnectionHandler(ConnectionHandler):
     """Singleton class that handles the communication between the python script and the external world via `OSC`
@@ -168,21 +313,76 @@ class OSCConnectionHandler(ConnectionHandler):
     """
     __instance = None
 
+    def __new__(cls, address: str, port: int):
+        """Returns the Singleton instance of the class, allocating it only the first time.
+
+        **Args:**
+
+        `address`: Net address to assign to the ConnectionHandler Singleton instance.
+
+        `address`: Net port to assign to the ConnectionHandler Singleton instance.
+
+        **Returns:**
+
+        The Singleton instance of the class.
+        """
+        if cls.__instance is None:
+            cls.__instance = super().__new__(cls)
+            cls.__instance._initialized = False
+        return cls.__instance
+
     def __init__(self, address: str, port: int):
-        """Singleton constructor. Starts the `OSC` communication channel.
+        """Singleton constructor. Starts the `OSC` communication channel the first time it's called and does nothing
+        afterwards, as the instance returned by `__new__` is always the same.
 
         **Args:**
 
         `address`: Net address to assign to the ConnectionHandler Singleton instance.
 
         `address`: Net port to assign to the ConnectionHandler Singleton instance.
+
+        **Class Attributes:**
+
+        `_initialized`: Whether the communication channel has already been started successfully.
+
+        `__socket`: `UDP` socket used to send the messages.
+
+        `__destination`: Address of the receiver, resolved once.
+
+        `__bundle`: Reused buffer in which the queued messages are encoded as an `OSC` bundle, each preceded by its
+        size.
+
+        `__queued`: Number of messages in `__bundle`.
+
+        `__max_queued`: Number of queued messages after which the queue is flushed anyway.
+
+        `__max_bytes`: Size in bytes that a bundle never exceeds, unless it contains a single message. Tuned by the
+        sender thread: it shrinks when the socket can't keep up and grows back, one step per packet sent, up to
+        `__bundle_bytes_limit`.
+
+        `__bundle_bytes_limit`: Largest value of `__max_bytes`, small enough to keep bundles in a single packet.
+
+        `__packets`: Encoded packets handed to the sender thread (`None` stops it).
+
+        `__sender`: Thread sending the packets, so that the audio path never waits on the socket.
         """
-        if OSCConnectionHandler.__instance is not None:
-            raise ce.SetupException("Tried to instantiate ConnectionHandler multiple times")
-        OSCConnectionHandler.__instance = self
+        if self._initialized:
+            return
 
         super().__init__(address=address, port=port)
-        self.__client = udp_client.SimpleUDPClient(self._address, self._port)
+        family, _, _, _, self.__destination = socket.getaddrinfo(self._address, self._port, type=socket.SOCK_DGRAM)[0]
+        self.__socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)  # Absorbs bursts of bundles
+        self.__socket.setblocking(False)  # Lets the sender thread notice when the socket buffer is full
+        self.__bundle = bytearray(_BUNDLE_HEADER)
+        self.__queued = 0
+        self.__max_queued = NET_PARAMETERS['maxQueuedMessages']
+        self.__max_bytes = NET_PARAMETERS['maxBundleBytes']
+        self.__bundle_bytes_limit = self.__max_bytes
+        self.__packets = SimpleQueue()
+        self.__sender = Thread(target=self.__send_packets, daemon=True)
+        self.__sender.start()
+        self._initialized = True  # Set last, so that a failed setup is retried by the next call
         
     @staticmethod
     def get_instance(address: str, port: int) -> OSCConnectionHandler:
@@ -198,28 +398,178 @@ class OSCConnectionHandler(ConnectionHandler):
 
         The Singleton instance of the class.
         """
-        if OSCConnectionHandler.__instance is None:
-            OSCConnectionHandler(address, port)
-        return OSCConnectionHandler.__instance
+        instance = OSCConnectionHandler.__instance
+        return instance if instance is not None and instance._initialized else OSCConnectionHandler(address, port)
     
     def send_message(self, message: Message):
-        """Sends a message over the network as an `OSC` message.
+        """Sends a message over the network as an `OSC` message. The message is encoded right away and sent by the
+        sender thread.
 
         **Args:**
 
         `message`: Message to be sent.
         """
-        self._lock.acquire()
-
         try:
-            self.__client.send_message(message.address, message.to_osc())
+            self.__packets.put(message.to_dgram())
         except Exception:
             print("Error while sending message")
-        finally:
-            self._lock.release()
+
+    def queue_message(self, message: Message):
+        """Queues a message, so that consecutive messages are sent with a single datagram when `flush` is called. If
+        too many messages are queued, or the bundle would grow larger than a packet, the messages already queued are
+        sent right away to keep the datagram small.
+
+        **Args:**
+
+        `message`: Message to be sent.
+        """
+        with self._lock:
+            start = len(self.__bundle)
+            try:
+                self.__bundle += b'\0\0\0\0'  # Size of the message, written once it's encoded
+                message.write_dgram(self.__bundle)
+                _ELEMENT_SIZE.pack_into(self.__bundle, start, len(self.__bundle) - start - _ELEMENT_SIZE.size)
+                # The new message starts the next bundle
+                if self.__queued > 0 and len(self.__bundle) > self.__max_bytes:
+                    message_bytes = self.__bundle[start:]
+                    del self.__bundle[start:]
+                    self.__send_queue()
+                    self.__bundle += message_bytes
+                self.__queued += 1
+                if self.__queued >= self.__max_queued:
+                    self.__send_queue()
+            except Exception:
+                del self.__bundle[start:]  # Drops the partially encoded message
+                print("Error while sending message")
+
+    def flush(self):
+        """Sends all the queued messages as a single `OSC` bundle (or as a plain message if only one is queued).
+        """
+        with self._lock:
+            try:
+                self.__send_queue()
+            except Exception:
+                print("Error while sending message")
+
+    def close(self):
+        """Waits until the sender thread has sent every packet handed to it and stops it. Has to be called before a
+        process ends, as the sender thread is stopped with it.
+        """
+        self.flush()
+        self.__packets.put(None)
+        self.__sender.join()
+        self.__socket.close()
+
+    def __send_queue(self):
+        """Hands the queued messages to the sender thread and empties the queue. Has to be called while holding the
+        lock.
+        """
+        if self.__queued == 1:  # A single message is sent on its own, without the bundle header and its size
+            self.__packets.put(bytes(self.__bundle[len(_BUNDLE_HEADER)+4:]))
+        elif self.__queued > 1:
+            self.__packets.put(bytes(self.__bundle))
+        del self.__bundle[len(_BUNDLE_HEADER):]
+        self.__queued = 0
+
+    def __send_packets(self):
+        """Sends the packets handed to the sender thread, one at a time. The socket is only used by this thread, so it
+        doesn't need a lock. The size of the bundles is tuned while sending (additive increase, multiplicative
+        decrease): it shrinks by 10% every time the socket buffer is full, as smaller bundles leave the queue sooner,
+        and grows back by a few bytes for every packet sent.
+        """
+        while True:
+            dgram = self.__packets.get()
+            if dgram is None:
+                return
+            try:
+                if not self.__try_send(dgram):
+                    self.__max_bytes = max(_MIN_BUNDLE_BYTES, int(self.__max_bytes * 0.9))
+                    select.select([], [self.__socket], [], _SEND_TIMEOUT)  # Waits for room in the socket buffer
+                    if not self.__try_send(dgram):
+                        print("Error while sending message")
+                        continue
+                self.__max_bytes = min(self.__bundle_bytes_limit, self.__max_bytes + _BUNDLE_BYTES_STEP)
+            except Exception:
+                print("Error while sending message")
+
+    def __try_send(self, dgram: bytes) -> bool:
+        """Sends a packet without waiting.
+
+        **Args:**
+
+        `dgram`: Packet to send.
+
+        **Returns:**
+
+        `True` if the packet was sent, `False` if the socket buffer is full.
+
+        **Raises:**
+
+        `OSError`: If the packet couldn't be sent for any other reason.
+        """
+        try:
+            self.__socket.sendto(dgram, self.__destination)
+            return True
+        except BlockingIOError:
+            return False
+        except OSError as e:
+            if e.errno == errno.ENOBUFS:
+                return False
+            raise
 
 
 # Incoming OSC Message Handlers
+_INSTRUMENTS = {instrument.get_string(): instrument for instrument in ut.Instruments}
+_IN_START = OSC_MESSAGES_PARAMETERS['inStart']
+_IN_STOP = OSC_MESSAGES_PARAMETERS['inStop']
+_IN_CHANNEL_SETTINGS = OSC_MESSAGES_PARAMETERS['inChannelSettings']
+_OSC_PATTERN_CHARACTERS = frozenset('*?[]{}')
+
+
+class _ExactDispatcher(Dispatcher):
+    """Dispatcher that looks up handlers with a dictionary access when the incoming address is mapped exactly, instead
+    of matching it against every mapped address with a regular expression. Falls back to pattern matching for `OSC`
+    address patterns, or if any mapped address is a pattern itself.
+    """
+
+    def __init__(self):
+        """Constructor for the _ExactDispatcher class.
+
+        **Class Attributes:**
+
+        `_has_patterns`: Whether any of the mapped addresses contains a wildcard.
+        """
+        super().__init__()
+        self._has_patterns = False
+
+    def map(self, address: str, handler, *args, **kwargs):
+        """Maps an address to a handler, see `Dispatcher.map`.
+
+        **Returns:**
+
+        The handler created for the mapping.
+        """
+        self._has_patterns = self._has_patterns or not _OSC_PATTERN_CHARACTERS.isdisjoint(address)
+        return super().map(address, handler, *args, **kwargs)
+
+    def handlers_for_address(self, address_pattern: str):
+        """Yields the handlers mapped to an address, see `Dispatcher.handlers_for_address`.
+
+        **Args:**
+
+        `address_pattern`: Address of the incoming message.
+
+        **Returns:**
+
+        A generator yielding the handlers of the address.
+        """
+        handlers = self._map.get(address_pattern)
+        if handlers and not self._has_patterns and _OSC_PATTERN_CHARACTERS.isdisjoint(address_pattern):
+            yield from handlers
+        else:
+            yield from super().handlers_for_address(address_pattern)
+
+
 def default_handler(address, *args):
     """Handles OSC messages with unrecognized addresses.
 
@@ -239,20 +589,21 @@ def handler_ch_settings(address, fixed_args, *osc_args):
     `*osc_args`: Arguments of the OSC message.
     """
     ut.print_info("Received ch_settings message")
-    queues = fixed_args[0]
+    channel_settings = fixed_args[0]
     channels = fixed_args[1]
-    try:
-        track = osc_args[0]
-        if track < 0 or track >= channels: raise ce.MessageReceiveException("Invalid channel number (was " + str(track) + ")")
-        instrument = ut.Instruments.from_string(osc_args[1])
-        setting = [track, instrument]
-    except Exception as e:
-        ut.print_error("Something bad happened while handling Channel Settings message")
-        ut.print_dbg(e)
+    if len(osc_args) < 2 or not isinstance(osc_args[0], int) or not isinstance(osc_args[1], str):
+        ut.print_error("Malformed Channel Settings message (arguments were " + str(osc_args) + ")")
+        return
+    track = osc_args[0]
+    if track < 0 or track >= channels:
+        ut.print_error("Invalid channel number (was " + str(track) + ")")
+        return
+    instrument = _INSTRUMENTS.get(osc_args[1])
+    if instrument is None:
+        ut.print_error("Unknown instrument (was " + osc_args[1] + ")")
         return
 
-    for q in queues:
-        q.put(setting)
+    channel_settings.set_instrument(track, instrument)
 
 
 def handler_start(address, *args):
@@ -277,21 +628,21 @@ def handler_stop(address, *args):
     ut.print_info("Received stopping message")
 
 
-def create_dispatcher(settings_queues, channels):
+def create_dispatcher(channel_settings: SharedChannelSettings, channels):
     """Creates a dispatcher to map incoming OSC messages into functions.
 
     **Args:**
 
-    `settings_queues`: Multiprocessing queues in which to put incoming settings.
+    `channel_settings`: Shared settings in which to write incoming settings.
     `channels`: Max number of channels currently being processed.
 
     **Returns:**
 
     A dispatcher for an OSC server.
     """
-    dispatcher = Dispatcher()
-    dispatcher.map(OSC_MESSAGES_PARAMETERS['inStart'], handler_start)
-    dispatcher.map(OSC_MESSAGES_PARAMETERS['inStop'], handler_stop)
-    dispatcher.map(OSC_MESSAGES_PARAMETERS['inChannelSettings'], handler_ch_settings, settings_queues, channels)
+    dispatcher = _ExactDispatcher()
+    dispatcher.map(_IN_START, handler_start)
+    dispatcher.map(_IN_STOP, handler_stop)
+    dispatcher.map(_IN_CHANNEL_SETTINGS, handler_ch_settings, channel_settings, channels)
     dispatcher.set_default_handler(default_handler)
     return dispatcher
\ No newline at end of file
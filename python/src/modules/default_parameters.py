@@ -6,6 +6,8 @@ NET_PARAMETERS = {
     'outNetPort': 12345,
     'inNetAddress': "127.0.0.1",
     'inNetPort': 1337,
+    'maxQueuedMessages': 16,  # Messages sent together in a single OSC bundle
+    'maxBundleBytes': 1200  # Keeps each bundle in a single packet (typical MTU of 1500 bytes, minus headers)
 }
 
 OSC_MESSAGES_PARAMETERS = {
@@ -26,11 +28,23 @@ AUDIO_PROCESSING_PARAMETERS = {
     'winType': 'hann',
     'hfNumberOfSamples': 22050,
     'hfMovingAverageLengthInSeconds': 5,
+    'hfModelSampleRate': None,  # Sample rate the neural network was trained at (None to feed it audio as captured)
     'pitchThreshold': 0.2,
+    'tonalityThreshold': 3.0,  # Peak to mean magnitude ratio under which no pitch is searched (0 to always search)
     'normType': Normalizations.PEAK
 }
 
 CPU_PARAMETERS = {
     'numLfCores': 2,
-    'numHfCores': 1
+    'numHfCores': 1,
+    'pinWorkers': True,
+    'producerRealtimePriority': 70
+}
+
+BUFFER_PARAMETERS = {
+    'lfRingSlots': 32,
+    'lfBatchSize': 4,
+    'hfRingSlots': 4,
+    'hfBatchSize': 4,
+    'lockRingsInMemory': True
 }
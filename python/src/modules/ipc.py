@@ -0,0 +1,321 @@
+from __future__ import annotations
+import ctypes
+import ctypes.util
+from multiprocessing import Array, Lock, Semaphore, Value
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from modules.utilities import Instruments, MEMORY_ALIGNMENT, aligned_empty
+
+
+class SharedAudioRing:
+    """Fixed-size ring buffer of audio chunks stored in shared memory. Used to move audio between processes without
+    pickling it: the producer copies each chunk into a preallocated slot and the consumers read it in place from the
+    same memory block.
+    """
+
+    def __init__(self, slots: int, shape: tuple, dtype):
+        """Constructor for the SharedAudioRing class. Has to be called before the worker processes are started.
+
+        **Args:**
+
+        `slots`: Number of chunks the ring can hold at the same time.
+
+        `shape`: Shape of a single chunk of audio.
+
+        `dtype`: Numpy format of the audio samples.
+
+        **Class Attributes:**
+
+        `_slots`: Number of chunks the ring can hold at the same time.
+
+        `_shape`: Shape of a single chunk of audio.
+
+        `_dtype`: Numpy format of the audio samples.
+
+        `_slot_bytes`: Distance in bytes between two slots, rounded up so that every slot starts on an aligned address.
+
+        `_shm`: Shared memory block containing all the slots of the ring.
+
+        `_head`: Shared counter of the chunks written by the producer.
+
+        `_tail`: Shared counter of the chunks read by the consumers.
+
+        `_closed`: Shared flag set when the producer won't write any more chunks.
+
+        `_busy`: Shared flags set for the slots that are currently being read by a consumer.
+
+        `_dropped`: Shared counter of the chunks dropped because the consumers couldn't keep up.
+
+        `_lock`: Mutex lock protecting the counters and flags of the ring.
+
+        `_available`: Semaphore counting the chunks waiting to be read, used to wake up the consumers.
+
+        `_buffer`: Numpy view of the shared memory block with shape `(slots, *shape)`.
+
+        `_reading`: Range of the slots currently held by this process (`None` if no slot is held).
+
+        `_writing`: Index of the slot reserved by the producer (`None` if the chunk is being written to `_scratch`).
+
+        `_scratch`: Private buffer handed to the producer when the slot to write is still being read.
+        """
+        self._slots = slots
+        self._shape = tuple(shape)
+        self._dtype = np.dtype(dtype)
+        chunk_bytes = int(np.prod(self._shape)) * self._dtype.itemsize
+        self._slot_bytes = -(-chunk_bytes // MEMORY_ALIGNMENT) * MEMORY_ALIGNMENT
+        self._shm = SharedMemory(create=True, size=slots * self._slot_bytes)
+        self._head = Value('Q', 0, lock=False)
+        self._tail = Value('Q', 0, lock=False)
+        self._closed = Value('b', False, lock=False)
+        self._busy = Array('b', slots, lock=False)
+        self._dropped = Value('Q', 0, lock=False)
+        self._lock = Lock()
+        self._available = Semaphore(0)
+        self._buffer = self.__create_view()
+        self._buffer.fill(0)  # Touches every page now, instead of faulting them in on the audio path
+        self._reading = None
+        self._writing = None
+        self._scratch = None
+
+    def __getstate__(self) -> dict:
+        """Removes the numpy view from the pickled state, as it can't be sent to another process.
+
+        **Returns:**
+
+        The state of the object without the `_buffer` attribute.
+        """
+        state = self.__dict__.copy()
+        del state['_buffer']
+        return state
+
+    def __setstate__(self, state: dict):
+        """Restores the object in a child process and rebuilds the numpy view over the shared memory block.
+
+        **Args:**
+
+        `state`: State of the object as returned by `__getstate__`.
+        """
+        self.__dict__.update(state)
+        self._buffer = self.__create_view()
+
+    def __create_view(self) -> np.ndarray:
+        """Creates a numpy view over the shared memory block.
+
+        **Returns:**
+
+        An array of shape `(slots, *shape)` sharing its memory with the other processes.
+        """
+        chunk_strides = np.empty(self._shape, dtype=self._dtype).strides
+        return np.ndarray(shape=(self._slots, *self._shape), dtype=self._dtype, buffer=self._shm.buf,
+                          strides=(self._slot_bytes, *chunk_strides))
+
+    def lock_in_memory(self) -> bool:
+        """Locks the shared memory block into RAM with `mlock`, so that its pages are never swapped out while audio is
+        running. Needs a large enough locked memory limit (`ulimit -l`) and a platform providing `mlock`.
+
+        **Returns:**
+
+        `True` if the memory was locked, `False` otherwise.
+        """
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            return False
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'mlock'):
+            return False
+        return libc.mlock(ctypes.c_void_p(self._buffer.ctypes.data), ctypes.c_size_t(self._shm.size)) == 0
+
+    def reserve(self) -> np.ndarray:
+        """Reserves the next slot of the ring, so that the producer can write a chunk straight into shared memory
+        instead of preparing it somewhere else and having `put` copy it. The chunk becomes visible to the consumers only
+        when `commit` is called. If the consumers can't keep up, the oldest unread chunk is dropped to keep latency
+        bounded; if the slot is still being read, a private scratch buffer is returned instead and the chunk is dropped
+        on commit. Drops are counted rather than reported, as this runs on the audio path.
+
+        **Returns:**
+
+        A writable array of shape `shape`. Every sample of it has to be written before calling `commit`.
+        """
+        with self._lock:
+            head = self._head.value
+            index = head % self._slots
+            if self._busy[index]:
+                self._writing = None
+            else:
+                if head - self._tail.value >= self._slots:  # The new chunk takes the place of the oldest one
+                    self._tail.value += 1  # Its wakeup is left to the consumers, see `get_batch`
+                    self._dropped.value += 1
+                self._writing = index
+
+        if self._writing is None:
+            if self._scratch is None:
+                self._scratch = aligned_empty(self._shape, self._dtype)
+            return self._scratch
+        return self._buffer[self._writing]
+
+    def commit(self):
+        """Publishes the chunk written in the slot returned by `reserve` and wakes up one of the consumers.
+        """
+        with self._lock:
+            if self._writing is None:
+                self._dropped.value += 1
+                return
+            self._head.value += 1
+        self._writing = None
+        self._available.release()
+
+    def put(self, chunk):
+        """Copies a chunk of audio into the next slot of the ring. Chunks shorter than the slot (e.g. the end of a
+        recorded song) are padded with zeros. The same drop rules of `reserve` apply.
+
+        **Args:**
+
+        `chunk`: Chunk of audio to write.
+        """
+        slot = self.reserve()
+        frames = np.shape(chunk)[-1]
+        slot[..., :frames] = chunk
+        slot[..., frames:] = 0
+        self.commit()
+
+    def get(self):
+        """Waits for the next chunk of audio and returns a view of its slot, without copying it. The slot previously
+        held by this process is released first, so the returned view stays valid only until the next call to `get`,
+        `get_batch` or `release` and must not be modified.
+
+        **Returns:**
+
+        The next chunk of audio, or `None` if the ring was closed and all of its chunks have been read.
+        """
+        batch = self.get_batch(1)
+        return None if batch is None else batch[0]
+
+    def get_batch(self, max_chunks: int):
+        """Waits for new chunks of audio and returns a view of up to `max_chunks` consecutive slots, claimed with a
+        single synchronization. Under load this lets a consumer drain several chunks per wakeup without adding any
+        latency when chunks arrive one at a time. The same validity rules of `get` apply to the returned view.
+        Wakeups of dropped chunks aren't taken back by the producer, as it can't know whether a consumer is already
+        awake for them: the ready chunks are recounted under the lock after every wakeup, and a consumer that finds
+        none just waits again.
+
+        **Args:**
+
+        `max_chunks`: Maximum number of chunks to return.
+
+        **Returns:**
+
+        An array of shape `(n, *shape)` with `1 <= n <= max_chunks`, or `None` if the ring was closed and all of its
+        chunks have been read.
+        """
+        self.release()
+        while True:
+            self._available.acquire()
+            with self._lock:
+                tail = self._tail.value
+                start = tail % self._slots
+                count = min(self._head.value - tail, max_chunks, self._slots - start)  # Stops at the end of the ring
+                if count == 0 and self._closed.value:
+                    self._available.release()  # Wakes up the next consumer, so that it can end too
+                    return None
+                for index in range(start, start + count):
+                    self._busy[index] = True
+                self._tail.value = tail + count
+            if count > 0:
+                break
+
+        for _ in range(count - 1):  # Consumes the wakeups of the other claimed chunks
+            self._available.acquire(False)
+        self._reading = slice(start, start + count)
+        return self._buffer[self._reading]
+
+    def release(self):
+        """Gives the slots held by this process back to the producer. Doesn't take the lock: each flag is only cleared
+        by the process holding the slot, and a producer reading it a moment too early just counts a drop.
+        """
+        if self._reading is None:
+            return
+        busy = self._busy
+        for index in range(self._reading.start, self._reading.stop):
+            busy[index] = False
+        self._reading = None
+
+    def get_dropped(self) -> int:
+        """Getter for the `_dropped` attribute.
+
+        **Returns:**
+
+        The number of chunks dropped so far.
+        """
+        return self._dropped.value
+
+    def close(self):
+        """Signals the consumers that no more chunks will be written. Consumers will read the remaining chunks and then
+        receive `None`.
+        """
+        with self._lock:
+            self._closed.value = True
+        self._available.release()
+
+    def unlink(self):
+        """Releases the shared memory block. Has to be called by the main process once all workers have ended.
+        """
+        self._buffer = None
+        self._shm.close()
+        self._shm.unlink()
+
+
+class SharedChannelSettings:
+    """Settings of each input channel shared between processes. Every change bumps a version counter, so that readers
+    only have to compare a single integer per chunk of audio to know if something changed.
+    """
+
+    def __init__(self, instruments: list):
+        """Constructor for the SharedChannelSettings class. Has to be called before the worker processes are started.
+
+        **Args:**
+
+        `instruments`: Initial instrument of each channel.
+
+        **Class Attributes:**
+
+        `_instruments`: Shared array containing the index of the instrument of each channel.
+
+        `_version`: Shared counter incremented every time a setting changes.
+
+        `_lock`: Mutex lock used for synchronization purposes.
+        """
+        self._instruments = Array('i', [i.value for i in instruments], lock=False)
+        self._version = Value('Q', 0, lock=False)
+        self._lock = Lock()
+
+    def set_instrument(self, channel: int, instrument: Instruments):
+        """Synchronized setter for the instrument of a channel.
+
+        **Args:**
+
+        `channel`: Index of the channel.
+
+        `instrument`: New instrument to assign.
+        """
+        with self._lock:
+            self._instruments[channel] = instrument.value
+            self._version.value += 1
+
+    def get_instruments(self) -> list:
+        """Synchronized getter for the instruments of all channels.
+
+        **Returns:**
+
+        A `list` containing the instrument of each channel.
+        """
+        with self._lock:
+            return [Instruments.from_index(i) for i in self._instruments]
+
+    def get_version(self) -> int:
+        """Getter for the `_version` attribute. Doesn't take the lock, as it's meant to be polled once per chunk.
+
+        **Returns:**
+
+        The number of changes made to the settings so far.
+        """
+        return self._version.value
@@ -0,0 +1,220 @@
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True, fastmath=True, error_model='numpy')
+def rms(frame) -> float:
+    """Computes the root mean square of an audio frame in a single pass, without allocating temporary arrays.
+
+    **Args:**
+
+    `frame`: Audio frame to process.
+
+    **Returns:**
+
+    The rms of the frame.
+    """
+    total = 0.0
+    for sample in frame:
+        total += sample * sample
+    return np.sqrt(total / frame.shape[0])
+
+
+@njit(cache=True, fastmath=True, error_model='numpy')
+def channels_rms(frames, out):
+    """Computes the root mean square of each channel of a multichannel audio frame. Channels are processed one after
+    the other, as each worker is pinned to its own core.
+
+    **Args:**
+
+    `frames`: Audio frame to process, with shape `(channels, samples)`.
+
+    `out`: Array of length `channels` in which to write the rms of each channel.
+    """
+    for channel in range(frames.shape[0]):
+        out[channel] = rms(frames[channel])
+
+
+@njit(cache=True, fastmath=True, error_model='numpy')
+def channels_peak(frames, out):
+    """Computes the highest absolute value of each channel of a multichannel audio frame in a single pass, without
+    allocating the absolute values.
+
+    **Args:**
+
+    `frames`: Audio frame to process, with shape `(channels, samples)`.
+
+    `out`: Array of length `channels` in which to write the peak of each channel.
+    """
+    for channel in range(frames.shape[0]):
+        peak = 0.0
+        for sample in frames[channel]:
+            peak = max(peak, abs(sample))
+        out[channel] = peak
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def downmix(chunk, out):
+    """Averages all channels of a chunk of audio into a mono signal in a single pass, without allocating temporary
+    arrays and without holding the GIL.
+
+    **Args:**
+
+    `chunk`: Chunk of audio to mix down, with shape `(channels, samples)`.
+
+    `out`: Array of length `samples` in which to write the mono signal. Integer samples are rounded to the nearest
+    value, as truncating them would bias negative samples by one step.
+    """
+    channels, samples = chunk.shape
+    scale = 1.0 / channels
+    integer = out.dtype.kind == 'i' or out.dtype.kind == 'u'
+    for i in range(samples):
+        total = 0.0
+        for channel in range(channels):
+            total += chunk[channel, i]
+        if integer:
+            out[i] = round(total * scale)
+        else:
+            out[i] = total * scale
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def frame_and_window(frames, window, hop_length, out):
+    """Writes the windowed STFT frames of each signal straight into a preallocated array. Signals are centered by
+    padding `len(window) // 2` zeros on each side (as in `librosa.stft`), without building the padded copy.
+
+    **Args:**
+
+    `frames`: Signals to split into frames, with shape `(signals, samples)`.
+
+    `window`: Window of the STFT, with length `nfft`.
+
+    `hop_length`: Number of samples between the start of two consecutive frames.
+
+    `out`: Array in which to write the frames, with shape `(signals, stft_frames, nfft)`.
+    """
+    signals, samples = frames.shape
+    stft_frames, nfft = out.shape[1], out.shape[2]
+    for signal in range(signals):
+        for frame in range(stft_frames):
+            start = frame * hop_length - nfft // 2
+            low = min(max(0, -start), nfft)  # Samples of the frame falling inside the signal
+            high = max(min(nfft, samples - start), low)
+            for i in range(low):
+                out[signal, frame, i] = 0.0
+            for i in range(low, high):
+                out[signal, frame, i] = frames[signal, start + i] * window[i]
+            for i in range(high, nfft):
+                out[signal, frame, i] = 0.0
+
+
+@njit(cache=True, fastmath=True, error_model='numpy')
+def spectral_features(spectra, frequencies, out):
+    """Computes the spectral centroid, bandwidth, flatness and rolloff of magnitude spectra (with the same definitions
+    used by librosa), averaged over the stft frames of each signal. All features are computed in two passes over each
+    stft frame, without allocating temporary arrays.
+
+    **Args:**
+
+    `spectra`: Magnitude spectra, with shape `(signals, bins, stft_frames)`.
+
+    `frequencies`: Center frequency of each bin.
+
+    `out`: Array in which to write the features, with shape `(signals, 4)`.
+    """
+    signals, bins, stft_frames = spectra.shape
+    for signal in range(signals):
+        centroid_sum = 0.0
+        bandwidth_sum = 0.0
+        flatness_sum = 0.0
+        rolloff_sum = 0.0
+        for frame in range(stft_frames):
+            total = 0.0
+            weighted = 0.0
+            log_power = 0.0
+            power = 0.0
+            for i in range(bins):
+                magnitude = spectra[signal, i, frame]
+                total += magnitude
+                weighted += frequencies[i] * magnitude
+                squared = max(magnitude * magnitude, 1e-10)
+                log_power += np.log(squared)
+                power += squared
+            total = max(total, 1.1754944e-38)  # Smallest normal single precision float, as in librosa
+            centroid = weighted / total
+
+            spread = 0.0
+            cumulative = 0.0
+            rolloff = -1
+            for i in range(bins):
+                magnitude = spectra[signal, i, frame]
+                spread += magnitude * (frequencies[i] - centroid) ** 2
+                cumulative += magnitude
+                if rolloff < 0 and cumulative >= 0.85 * total:
+                    rolloff = i
+
+            centroid_sum += centroid
+            bandwidth_sum += np.sqrt(spread / total)
+            flatness_sum += np.exp(log_power / bins) / (power / bins)
+            rolloff_sum += frequencies[max(rolloff, 0)]
+
+        out[signal, 0] = centroid_sum / stft_frames
+        out[signal, 1] = bandwidth_sum / stft_frames
+        out[signal, 2] = flatness_sum / stft_frames
+        out[signal, 3] = rolloff_sum / stft_frames
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def parabolic_peaks(column, low, high, threshold, bin_width, pitches, magnitudes) -> int:
+    """Finds the loudest peaks of a magnitude spectrum inside a range of bins, with the same rules of
+    `librosa.piptrack` (local maxima above a threshold relative to the loudest bin, refined with parabolic
+    interpolation). Only the loudest `len(pitches)` peaks are kept while scanning, so nothing has to be sorted.
+
+    **Args:**
+
+    `column`: Magnitude spectrum of a single stft frame.
+
+    `low`: First bin of the range.
+
+    `high`: Bin after the last one of the range.
+
+    `threshold`: Fraction of the loudest bin under which peaks are discarded.
+
+    `bin_width`: Distance in Hz between two bins.
+
+    `pitches`: Array in which to write the frequency of the peaks, from the loudest to the quietest.
+
+    `magnitudes`: Array of the same length of `pitches` in which to write the magnitude of the peaks.
+
+    **Returns:**
+
+    The number of peaks written.
+    """
+    limit = threshold * np.max(column)
+    size = pitches.shape[0]
+    count = 0
+    for i in range(max(low, 1), min(high, column.shape[0] - 1)):  # Each peak needs a neighbour on both sides
+        magnitude = column[i]
+        if magnitude <= limit or magnitude <= column[i - 1] or magnitude < column[i + 1]:
+            continue
+        average = 0.5 * (column[i + 1] - column[i - 1])
+        curvature = 2.0 * magnitude - column[i + 1] - column[i - 1]
+        shift = average / curvature if abs(curvature) >= 1.1754944e-38 else average / (curvature + 1.0)
+        pitch = (i + shift) * bin_width
+        magnitude = magnitude + 0.5 * average * shift
+        if pitch <= 0.0:
+            continue
+        if count < size:
+            position = count
+            count += 1
+        elif magnitude > magnitudes[size - 1]:
+            position = size - 1
+        else:
+            continue
+        while position > 0 and magnitudes[position - 1] < magnitude:  # Insertion into the sorted peaks
+            pitches[position] = pitches[position - 1]
+            magnitudes[position] = magnitudes[position - 1]
+            position -= 1
+        pitches[position] = pitch
+        magnitudes[position] = magnitude
+    return count
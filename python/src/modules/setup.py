@@ -65,11 +65,12 @@ class SetupHandler:
         audio_type = user_input['audioType']
         self.__audio_parameters['mainPath'] = self.__main_path
         self.__audio_parameters['audioType'] = audio_type
-        self.__audio_parameters['sampleFormat'] = pyaudio.paFloat32
         self.__audio_parameters['npFormat'] = self.__get_numpy_format(pyaudio.paFloat32)
         self.__audio_parameters['instruments'] = user_input['instruments']
 
         if audio_type == "r":
+            self.__audio_parameters['sampleFormat'] = pyaudio.paFloat32
+            self.__audio_parameters['transportFormat'] = self.__get_numpy_format(pyaudio.paFloat32)
             tracks, sr = self.__file_handler.get_tracks(user_input['songIndex'])
             self.__audio_parameters['tracks'] = tracks
             self.__audio_parameters['sampleRate'] = sr
@@ -79,6 +80,8 @@ class SetupHandler:
         elif audio_type == "l":
             sound_card_info = self.__get_sound_card_info(user_input['soundCardIndex'])
             self.__audio_parameters['inputDeviceIndex'] = user_input['soundCardIndex']
+            self.__audio_parameters['sampleFormat'] = pyaudio.paInt16  # Halves the audio moved between processes
+            self.__audio_parameters['transportFormat'] = self.__get_numpy_format(pyaudio.paInt16)
             self.__audio_parameters['sampleRate'] = 44100
             self.__audio_parameters['channels'] = sound_card_info['inChannels']
             self.__audio_parameters['audioPlayback'] = False
@@ -127,11 +130,16 @@ class SetupHandler:
         """
         return self.__audio_parameters
     
-    def get_audio_streams(self) -> tuple:
+    def get_audio_streams(self, stream_callback=None) -> tuple:
         """Creates a new audio stream based on the audio parameters of the `SetupHandler`.
         Specifically, it creates an input stream if the user chose to use live audio, or an output stream
         if the user chose to use recorded audio and wants to hear the song while it's being processed.
 
+        **Args:**
+
+        `stream_callback`: Function called by PortAudio with every chunk captured by the input stream. If `None`, the
+        input stream has to be read in blocking mode.
+
         **Returns:**
 
         A `tuple` containing the input and output stream (`None` if they aren't created).
@@ -148,7 +156,8 @@ class SetupHandler:
                 rate=params['sampleRate'],
                 frames_per_buffer=params['chunkSize'],
                 input_device_index=params['inputDeviceIndex'],
-                input=True
+                input=True,
+                stream_callback=stream_callback
             )
         
         if params['audioPlayback']:
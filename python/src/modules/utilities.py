@@ -1,5 +1,9 @@
 from __future__ import annotations
+import os
 from enum import Enum
+from queue import Queue
+from threading import Thread
+import numpy as np
 from modules.custom_exceptions import SetupException
 
 
@@ -127,10 +131,55 @@ class BColors:
     UNDERLINE = '\033[4m'
 
 
+MEMORY_ALIGNMENT = 64  # Bytes, the width of a cache line and of an AVX-512 register
+
 __DEBUGGER_ACTIVE = True
 __PRINTING_ACTIVE = True
 __PRINTING_DATA_ACTIVE = True
 
+__log_queue = None
+__log_pid = None
+
+
+def __drain_log_queue(log_queue: Queue):
+    """Prints the messages posted on the log queue. Runs on a dedicated thread, so that writing to a slow terminal
+    never blocks the caller of the print functions.
+
+    **Args:**
+
+    `log_queue`: Queue containing the messages to print and whether to flush them.
+    """
+    while True:
+        args, flush = log_queue.get()
+        print(*args, flush=flush)
+        log_queue.task_done()
+
+
+def __log(*args, flush=True):
+    """Posts a message on the log queue of the current process without blocking. The queue and its printing thread
+    are created on first use in each process, as neither survives a fork.
+
+    **Args:**
+
+    `*args`: Objects to print.
+
+    `flush`: Whether to flush when using built-in print function.
+    """
+    global __log_queue, __log_pid
+    if __log_pid != os.getpid():
+        __log_queue = Queue()
+        __log_pid = os.getpid()
+        Thread(target=__drain_log_queue, args=(__log_queue,), daemon=True).start()
+    __log_queue.put_nowait((args, flush))
+
+
+def flush_logs():
+    """Waits until all the messages posted by the current process have been printed. Has to be called before a
+    process ends, as the printing thread is stopped with it.
+    """
+    if __log_pid == os.getpid():
+        __log_queue.join()
+
 
 def print_success(string, flush=True):
     """Prints a success message if printing is active.
@@ -142,7 +191,7 @@ def print_success(string, flush=True):
     `flush`: Whether to flush when using built-in print function.
     """
     if __PRINTING_ACTIVE:
-        print(BColors.OKGREEN + "[OK] " + str(string) + BColors.ENDC, flush=flush)
+        __log(BColors.OKGREEN + "[OK] " + str(string) + BColors.ENDC, flush=flush)
 
 
 def print_info(string, flush=True):
@@ -155,7 +204,7 @@ def print_info(string, flush=True):
     `flush`: Whether to flush when using built-in print function.
     """
     if __PRINTING_ACTIVE:
-        print(BColors.OKBLUE + "[INFO] " + BColors.UNDERLINE + str(string) + BColors.ENDC, flush=flush)
+        __log(BColors.OKBLUE + "[INFO] " + BColors.UNDERLINE + str(string) + BColors.ENDC, flush=flush)
 
 
 def print_data(channel, data, flush=True):
@@ -170,7 +219,7 @@ def print_data(channel, data, flush=True):
     `flush`: Whether to flush when using built-in print function.
     """
     if __PRINTING_DATA_ACTIVE:
-        print(BColors.OKCYAN + "[DATA - Channel " + str(channel) + "] ", data, BColors.ENDC, flush=flush)
+        __log(BColors.OKCYAN + "[DATA - Channel " + str(channel) + "] ", data, BColors.ENDC, flush=flush)
 
 
 def print_data_alt_color(channel, data, flush=True):
@@ -185,7 +234,7 @@ def print_data_alt_color(channel, data, flush=True):
     `flush`: Whether to flush when using built-in print function.
     """
     if __PRINTING_DATA_ACTIVE:
-        print(BColors.HEADER + "[DATA - Channel " + str(channel) + "] ", data, BColors.ENDC, flush=flush)
+        __log(BColors.HEADER + "[DATA - Channel " + str(channel) + "] ", data, BColors.ENDC, flush=flush)
 
 
 def print_warning(string, flush=True):
@@ -198,7 +247,7 @@ def print_warning(string, flush=True):
     `flush`: Whether to flush when using built-in print function.
     """
     if __PRINTING_ACTIVE:
-        print(BColors.WARNING + BColors.BOLD + "[WARNING] " + str(string) + BColors.ENDC, flush=flush)
+        __log(BColors.WARNING + BColors.BOLD + "[WARNING] " + str(string) + BColors.ENDC, flush=flush)
 
 
 def print_error(string, flush=True):
@@ -211,7 +260,7 @@ def print_error(string, flush=True):
     `flush`: Whether to flush when using built-in print function.
     """
     if __PRINTING_ACTIVE:
-        print(BColors.FAIL + BColors.BOLD + "[ERROR] " + str(string) + BColors.ENDC, flush=flush)
+        __log(BColors.FAIL + BColors.BOLD + "[ERROR] " + str(string) + BColors.ENDC, flush=flush)
 
 
 def print_dbg(string, flush=True):
@@ -224,4 +273,113 @@ def print_dbg(string, flush=True):
     `flush`: Whether to flush when using built-in print function.
     """
     if __PRINTING_ACTIVE and __DEBUGGER_ACTIVE:
-        print(BColors.OKGREEN + "[DBG] " + str(string) + BColors.ENDC, flush=flush)
+        __log(BColors.OKGREEN + "[DBG] " + str(string) + BColors.ENDC, flush=flush)
+
+
+def get_worker_cores(number_of_workers: int) -> list:
+    """Chooses a dedicated CPU core for each worker process. Core 0 is left to the operating system (interrupts) when
+    there are enough cores.
+
+    **Args:**
+
+    `number_of_workers`: Number of worker processes to assign a core to.
+
+    **Returns:**
+
+    A `list` containing a core index for each worker, or `None` values if workers can't have a dedicated core (not
+    enough cores, or CPU affinity isn't supported by the platform).
+    """
+    if not hasattr(os, 'sched_getaffinity'):
+        return [None] * number_of_workers
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) > number_of_workers:
+        cores = cores[1:]
+    if len(cores) < number_of_workers:
+        return [None] * number_of_workers
+    return cores[:number_of_workers]
+
+
+def available_cores() -> int:
+    """Returns the number of CPU cores the calling process may run on.
+
+    **Returns:**
+
+    The number of cores in the CPU affinity of the process (1 for a pinned worker), or the number of cores of the
+    machine if CPU affinity isn't supported by the platform.
+    """
+    if not hasattr(os, 'sched_getaffinity'):
+        return os.cpu_count()
+    return len(os.sched_getaffinity(0))
+
+
+def pin_to_core(core):
+    """Pins the calling process (or thread, on Linux) to a CPU core, so that its caches stay warm between consecutive
+    chunks of audio.
+
+    **Args:**
+
+    `core`: Index of the core, or `None` to leave the process unpinned.
+    """
+    if core is None:
+        return
+    try:
+        os.sched_setaffinity(0, {core})
+    except OSError as e:
+        print_warning("Couldn't pin process to core " + str(core))
+        print_dbg(e)
+
+
+def set_realtime_priority(priority):
+    """Moves the calling process (or thread, on Linux) to the real-time FIFO scheduler, so that it isn't preempted by
+    the workers processing audio. Threads started afterwards (e.g. the PortAudio callback thread) inherit the same
+    policy. Needs the right privileges (e.g. an `rtprio` limit) and does nothing on platforms without `SCHED_FIFO`.
+
+    **Args:**
+
+    `priority`: Real-time priority to assign (1-99), or `None` to keep the default scheduler.
+    """
+    if priority is None or not hasattr(os, 'SCHED_FIFO'):
+        return
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except OSError as e:
+        print_warning("Couldn't set real-time priority " + str(priority))
+        print_dbg(e)
+
+
+def aligned_empty(shape, dtype) -> np.ndarray:
+    """Allocates an uninitialized array whose first element is aligned to `MEMORY_ALIGNMENT` bytes, so that FFT and
+    other vectorized kernels can use aligned loads and stores on it.
+
+    **Args:**
+
+    `shape`: Shape of the array.
+
+    `dtype`: Numpy format of the array.
+
+    **Returns:**
+
+    The aligned array.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buffer = np.empty(nbytes + MEMORY_ALIGNMENT, dtype=np.uint8)
+    offset = -buffer.ctypes.data % MEMORY_ALIGNMENT
+    return buffer[offset:offset+nbytes].view(dtype).reshape(shape)
+
+
+def get_pcm_scale(dtype):
+    """Returns the factor that converts integer PCM samples of a given format to floats between -1 and 1.
+
+    **Args:**
+
+    `dtype`: Numpy format of the samples.
+
+    **Returns:**
+
+    The conversion factor, or `None` if the samples are already floats.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'i':
+        return None
+    return 1.0 / (np.iinfo(dtype).max + 1)